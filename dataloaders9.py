@@ -1,8 +1,118 @@
-import torch, torch.utils.data as torchdata
+import torch, torch.utils.data as torchdata, torch.nn.functional as F, torch.distributed as dist
 import torchvision, torchvision.transforms as transforms
 from torch.utils.data.sampler import SubsetRandomSampler
 from torch.utils.data import Subset
-import numpy as np
+from torch.utils.data.distributed import DistributedSampler
+import numpy as np, os, time, argparse
+
+packed_root = './data/packed'
+
+def available_cores():
+	return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+
+def is_distributed():
+	return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+class MemmapDataset(torchdata.Dataset):
+	# serves a split packed by pack_dataset as uint8 CHW tensor views of the memory-mapped NHWC array, the transforms then run on tensors
+	def __init__(self, name, split, trs, root = packed_root):
+		folder = os.path.join(root, name)
+		self.images = np.load(os.path.join(folder, split + '-images.npy'), mmap_mode = 'c')
+		self.targets = np.load(os.path.join(folder, split + '-labels.npy'))
+		self.transform = transforms.Compose(tensor_transforms(trs))
+	def __len__(self):
+		return len(self.targets)
+	def __getitem__(self, i):
+		x = torch.from_numpy(self.images[i]).permute(2, 0, 1)
+		return self.transform(x), int(self.targets[i])
+	def __getitems__(self, indices):
+		xs = torch.from_numpy(self.images[indices]).permute(0, 3, 1, 2)
+		return [(self.transform(x), int(self.targets[i])) for x, i in zip(xs, indices)]
+
+def tensor_transforms(trs):
+	trs = [transforms.ConvertImageDtype(torch.float) if isinstance(t, transforms.ToTensor) else t for t in trs]
+	return [t for t in trs if not isinstance(t, (transforms.ToPILImage, transforms.PILToTensor))]
+
+def set_unaugmented(loader, trs, backend, collate_fn = None):
+	# the transforms (and batch collate) of the train loader without its augmentations or noise, as given by each dataloaders function, so 
+	# that unaugmented passes over the training samples (activation caching) never depend on guessing which transforms augment
+	loader.unaugmented_transform = transforms.Compose(tensor_transforms(trs) if backend == 'memmap' else trs)
+	loader.unaugmented_collate = collate_fn.__self__.unaugmented().collate if collate_fn is not None else None
+	return loader
+
+class BatchAugment(object):
+	# pad, crop, flip, ToTensor-scale and normalize a whole uint8 NCHW batch with one gather. the padding is folded into the gather 
+	# indices (reflected or masked to zero) so no padded copy is made. crop is 'random' (RandomCrop) or 'center' (CenterCrop)
+	def __init__(self, size, mean, std, padding = 0, padding_mode = 'constant', crop = 'random', flip = True, noise = 0):
+		self.size, self.padding, self.padding_mode, self.crop, self.flip, self.noise = size, padding, padding_mode, crop, flip, noise
+		self.mean, self.std = torch.tensor(mean).view(1, -1, 1, 1), torch.tensor(std).view(1, -1, 1, 1)
+	def indices(self, n, length):
+		if self.crop == 'random':
+			offsets = torch.randint(0, length + 2 * self.padding - self.size + 1, (n, 1))
+		else:
+			offsets = torch.full((n, 1), (length + 2 * self.padding - self.size) // 2)
+		i = offsets - self.padding + torch.arange(self.size)
+		if self.padding_mode == 'reflect':
+			i = i.abs()
+			i = torch.where(i > length - 1, 2 * (length - 1) - i, i)
+		return i.clamp(0, length - 1), (i >= 0) & (i < length)
+	def __call__(self, x):
+		n, c, h, w = x.shape
+		rows, rowsin = self.indices(n, h)
+		cols, colsin = self.indices(n, w)
+		if self.flip:
+			flip = torch.rand(n, 1) < 0.5
+			cols, colsin = torch.where(flip, cols.flip(1), cols), torch.where(flip, colsin.flip(1), colsin)
+		out = x[torch.arange(n).view(n, 1, 1, 1), torch.arange(c).view(1, c, 1, 1), rows.view(n, 1, -1, 1), cols.view(n, 1, 1, -1)].float().div_(255)
+		if self.padding > 0 and self.padding_mode == 'constant':
+			out.mul_(rowsin.view(n, 1, -1, 1) & colsin.view(n, 1, 1, -1))
+		if self.noise:
+			out.add_(self.noise * torch.randn_like(out))
+		return out.sub_(self.mean).div_(self.std)
+	def collate(self, batch):
+		x, y = zip(*batch)
+		return self(torch.stack(x)), torch.tensor(y)
+	def unaugmented(self):
+		return BatchAugment(self.size, self.mean.flatten().tolist(), self.std.flatten().tolist(), crop = 'center', flip = False)
+
+def raw_datasets(name):
+	fixed = transforms.Compose([transforms.Resize(256), transforms.CenterCrop(256)])
+	if name == 'mnist':
+		return {'train': torchvision.datasets.MNIST(root = './data', train = True, download = True), 'test': torchvision.datasets.MNIST(root = './data', train = False, download = True)}
+	if name == 'cifar10':
+		return {'train': torchvision.datasets.CIFAR10(root = './data', train = True, download = True), 'test': torchvision.datasets.CIFAR10(root = './data', train = False, download = True)}
+	if name == 'cifar100':
+		return {'train': torchvision.datasets.CIFAR100(root = './data', train = True, download = True), 'test': torchvision.datasets.CIFAR100(root = './data', train = False, download = True)}
+	if name == 'stl10':
+		return {'train': torchvision.datasets.STL10(root = './data', split = 'train', download = True), 'test': torchvision.datasets.STL10(root = './data', split = 'test', download = True)}
+	if name == 'tinyimagenet':
+		return {'train': torchvision.datasets.ImageFolder(root = './data/tiny-imagenet-200/train'), 'test': torchvision.datasets.ImageFolder(root = './data/tiny-imagenet-200/test')}
+	if name == 'imagenet2012':
+		return {'train': torchvision.datasets.ImageFolder(root = '/data/common-data/imagenet_2012/images/train', transform = fixed), 
+				'val': torchvision.datasets.ImageFolder(root = '/data/common-data/imagenet_2012/images/val', transform = fixed)}
+	if name == 'imagenetdownloader':
+		return {'train': torchvision.datasets.ImageFolder(root = './data/imagenet-downloader/imagenet-downloader-500-500-seed0', transform = fixed)}
+	raise ValueError('cannot pack dataset: ' + name)
+
+def pack_dataset(name, root = packed_root, nworkers = 4):
+	# one-time decoding of every split into a uint8 NHWC array and an int64 label array, both .npy so they can be memory-mapped
+	folder = os.path.join(root, name)
+	os.makedirs(folder, exist_ok = True)
+	for split, dataset in raw_datasets(name).items():
+		t, n = time.time(), len(dataset)
+		loader = torchdata.DataLoader(dataset, batch_size = 256, shuffle = False, num_workers = nworkers, collate_fn = lambda batch : batch)
+		images, labels, k = None, np.lib.format.open_memmap(os.path.join(folder, split + '-labels.npy'), mode = 'w+', dtype = np.int64, shape = (n, )), 0
+		for batch in loader:
+			for img, label in batch:
+				img = np.asarray(img, dtype = np.uint8)
+				img = img[:, :, None] if img.ndim == 2 else img
+				if images is None:
+					images = np.lib.format.open_memmap(os.path.join(folder, split + '-images.npy'), mode = 'w+', dtype = np.uint8, shape = (n, ) + img.shape)
+				images[k], labels[k] = img, label
+				k += 1
+		images.flush()
+		labels.flush()
+		print('packed', name, split, images.shape, 'in %.1f s' % (time.time() - t))
 
 def mean_and_std(datafolder = './train', batchsize = 300000, nworkers = 4):
 	trainset = torchvision.datasets.ImageFolder(root = datafolder, transform = transforms.ToTensor())
@@ -24,120 +134,208 @@ def mean_and_std(datafolder = './train', batchsize = 300000, nworkers = 4):
 	pop_std1 = list(np.array(pop_std1).mean(axis = 0))	
 	return pop_mean, pop_std0, pop_std1
 
-def cifar10_dataloaders(batchsize, trainsize = 1, valsize = 0.5, testsize = 0.5, noise = 0, shuffle = False):
+def cifar10_dataloaders(batchsize, trainsize = 1, valsize = 0.5, testsize = 0.5, noise = 0, shuffle = False, backend = 'torchvision', batchaug = False, loaderargs = None):
 	datashape, mean, std, nclasses = (1, 3, 32, 32), (0.49139968, 0.48215841, 0.44653091), (0.24703223, 0.24348513, 0.26158784), 10
 	test_transforms = [transforms.ToTensor(), transforms.Normalize(mean, std)] if noise == 0 else [transforms.ToTensor(), transforms.Lambda(lambda x : x + noise * torch.randn_like(x)), transforms.Normalize(mean, std)]
 	train_transforms = [transforms.ToTensor(), transforms.Lambda(lambda x: F.pad(x.unsqueeze(0), (4, 4, 4, 4), mode = 'reflect').squeeze()), transforms.ToPILImage(), transforms.RandomCrop(32), 
 						transforms.RandomHorizontalFlip(), transforms.ToTensor(), transforms.Normalize(mean, std)]
-	trainset = torchvision.datasets.CIFAR10(root = './data', train = True, download = True, transform = transforms.Compose(train_transforms))
-	testset = torchvision.datasets.CIFAR10(root = './data', train = False, download = True, transform = transforms.Compose(test_transforms))
-	trainloader = get_subset_loader(trainset, batchsize, trainsize)
-	valloader, testloader = get_subset_loaders(testset, batchsize, [valsize, testsize], shuffle)
+	unaugmented = [transforms.ToTensor(), transforms.Normalize(mean, std)]
+	traincollate = testcollate = None
+	if batchaug:
+		train_transforms = test_transforms = unaugmented = [transforms.PILToTensor()]
+		traincollate, testcollate = BatchAugment(32, mean, std, 4, 'reflect').collate, BatchAugment(32, mean, std, flip = False, noise = noise).collate
+	if backend == 'memmap':
+		trainset, testset = MemmapDataset('cifar10', 'train', train_transforms), MemmapDataset('cifar10', 'test', test_transforms)
+	else:
+		trainset = torchvision.datasets.CIFAR10(root = './data', train = True, download = True, transform = transforms.Compose(train_transforms))
+		testset = torchvision.datasets.CIFAR10(root = './data', train = False, download = True, transform = transforms.Compose(test_transforms))
+	trainloader = set_unaugmented(get_subset_loader(trainset, batchsize, trainsize, collate_fn = traincollate, loaderargs = loaderargs), unaugmented, backend, traincollate)
+	valloader, testloader = get_subset_loaders(testset, batchsize, [valsize, testsize], shuffle, testcollate, loaderargs = loaderargs)
 	return trainloader, valloader, testloader, datashape, nclasses, np.array(mean), np.array(std)
 
-def stl10_dataloaders(batchsize, trainsize = 1, valsize = 0.5, testsize = 0.5, noise = 0, shuffle = False):
+def stl10_dataloaders(batchsize, trainsize = 1, valsize = 0.5, testsize = 0.5, noise = 0, shuffle = False, backend = 'torchvision', batchaug = False, loaderargs = None):
 	datashape, mean, std, nclasses = (1, 3, 96, 96), [x / 255 for x in [127.5, 127.5, 127.5]], [x / 255 for x in [127.5, 127.5, 127.5]], 10
 	transform = [transforms.ToTensor(), transforms.Normalize(mean, std)] if noise == 0 else [transforms.ToTensor(), transforms.Lambda(lambda x : x + noise * torch.randn_like(x)), transforms.Normalize(mean, std)]
 	data_aug = [transforms.RandomCrop(datashape[-1], padding = 4), transforms.RandomHorizontalFlip()]
 	train_transforms = data_aug + transform 
-	test_transforms = transform
-	trainset = torchvision.datasets.STL10(root = './data', split = 'train', download = True, transform = transforms.Compose(train_transforms))
-	testset = torchvision.datasets.STL10(root = './data', split = 'test', download = True, transform = transforms.Compose(test_transforms))
-	trainloader = get_subset_loader(trainset, batchsize, trainsize)
-	valloader, testloader = get_subset_loaders(testset, batchsize, [valsize, testsize], shuffle)
+	test_transforms, unaugmented = transform, [transforms.ToTensor(), transforms.Normalize(mean, std)]
+	traincollate = testcollate = None
+	if batchaug:
+		train_transforms = test_transforms = unaugmented = [transforms.PILToTensor()]
+		traincollate, testcollate = BatchAugment(datashape[-1], mean, std, 4, noise = noise).collate, BatchAugment(datashape[-1], mean, std, flip = False, noise = noise).collate
+	if backend == 'memmap':
+		trainset, testset = MemmapDataset('stl10', 'train', train_transforms), MemmapDataset('stl10', 'test', test_transforms)
+	else:
+		trainset = torchvision.datasets.STL10(root = './data', split = 'train', download = True, transform = transforms.Compose(train_transforms))
+		testset = torchvision.datasets.STL10(root = './data', split = 'test', download = True, transform = transforms.Compose(test_transforms))
+	trainloader = set_unaugmented(get_subset_loader(trainset, batchsize, trainsize, collate_fn = traincollate, loaderargs = loaderargs), unaugmented, backend, traincollate)
+	valloader, testloader = get_subset_loaders(testset, batchsize, [valsize, testsize], shuffle, testcollate, loaderargs = loaderargs)
 	return trainloader, valloader, testloader, datashape, nclasses, np.array(mean), np.array(std)
 
 
-def cifar100_dataloaders(batchsize, trainsize = 1, valsize = 0.5, testsize = 0.5, noise = 0, shuffle = False):
+def cifar100_dataloaders(batchsize, trainsize = 1, valsize = 0.5, testsize = 0.5, noise = 0, shuffle = False, backend = 'torchvision', batchaug = False, loaderargs = None):
 	datashape, mean, std, nclasses = (1, 3, 32, 32), (0.49139968, 0.48215841, 0.44653091), (0.24703223, 0.24348513, 0.26158784), 100
 	transform = [transforms.ToTensor(), transforms.Normalize(mean, std)] if noise == 0 else [transforms.ToTensor(), transforms.Lambda(lambda x : x + noise * torch.randn_like(x)), transforms.Normalize(mean, std)]
 	data_aug = [transforms.RandomCrop(datashape[-1], padding = 4), transforms.RandomHorizontalFlip()]
 	train_transforms = data_aug + transform 
-	test_transforms = transform
-	trainset = torchvision.datasets.CIFAR100(root = './data', train = True, download = True, transform = transforms.Compose(train_transforms))
-	testset = torchvision.datasets.CIFAR100(root = './data', train = False, download = True, transform = transforms.Compose(test_transforms))
-	trainloader = get_subset_loader(trainset, batchsize, trainsize)
-	valloader, testloader = get_subset_loaders(testset, batchsize, [valsize, testsize], shuffle)
+	test_transforms, unaugmented = transform, [transforms.ToTensor(), transforms.Normalize(mean, std)]
+	traincollate = testcollate = None
+	if batchaug:
+		train_transforms = test_transforms = unaugmented = [transforms.PILToTensor()]
+		traincollate, testcollate = BatchAugment(datashape[-1], mean, std, 4, noise = noise).collate, BatchAugment(datashape[-1], mean, std, flip = False, noise = noise).collate
+	if backend == 'memmap':
+		trainset, testset = MemmapDataset('cifar100', 'train', train_transforms), MemmapDataset('cifar100', 'test', test_transforms)
+	else:
+		trainset = torchvision.datasets.CIFAR100(root = './data', train = True, download = True, transform = transforms.Compose(train_transforms))
+		testset = torchvision.datasets.CIFAR100(root = './data', train = False, download = True, transform = transforms.Compose(test_transforms))
+	trainloader = set_unaugmented(get_subset_loader(trainset, batchsize, trainsize, collate_fn = traincollate, loaderargs = loaderargs), unaugmented, backend, traincollate)
+	valloader, testloader = get_subset_loaders(testset, batchsize, [valsize, testsize], shuffle, testcollate, loaderargs = loaderargs)
 	return trainloader, valloader, testloader, datashape, nclasses, np.array(mean), np.array(std)
 
-def mnist_dataloaders(batchsize, trainsize = 1, valsize = 0.5, testsize = 0.5, noise = 0, shuffle = False):
+def mnist_dataloaders(batchsize, trainsize = 1, valsize = 0.5, testsize = 0.5, noise = 0, shuffle = False, backend = 'torchvision', batchaug = False, loaderargs = None):
 	datashape, mean, std, nclasses = (1, 1, 28, 28), (0.1306604762738429, ), (0.30810780717887876, ), 10
 	transform = [transforms.ToTensor(), transforms.Normalize(mean, std)] if noise == 0 else [transforms.ToTensor(), transforms.Lambda(lambda x : x + noise * torch.randn_like(x)), transforms.Normalize(mean, std)]
 	data_aug = [transforms.RandomCrop(datashape[-1], padding = 4), transforms.RandomHorizontalFlip()]
 	train_transforms = data_aug + transform 
-	test_transforms = transform
-	trainset = torchvision.datasets.MNIST(root = './data', train = True, download = True, transform = transforms.Compose(train_transforms))
-	testset = torchvision.datasets.MNIST(root = './data', train = False, download = True, transform = transforms.Compose(test_transforms))
-	trainloader = get_subset_loader(trainset, batchsize, trainsize)
-	valloader, testloader = get_subset_loaders(testset, batchsize, [valsize, testsize], shuffle)
+	test_transforms, unaugmented = transform, [transforms.ToTensor(), transforms.Normalize(mean, std)]
+	traincollate = testcollate = None
+	if batchaug:
+		train_transforms = test_transforms = unaugmented = [transforms.PILToTensor()]
+		traincollate, testcollate = BatchAugment(datashape[-1], mean, std, 4, noise = noise).collate, BatchAugment(datashape[-1], mean, std, flip = False, noise = noise).collate
+	if backend == 'memmap':
+		trainset, testset = MemmapDataset('mnist', 'train', train_transforms), MemmapDataset('mnist', 'test', test_transforms)
+	else:
+		trainset = torchvision.datasets.MNIST(root = './data', train = True, download = True, transform = transforms.Compose(train_transforms))
+		testset = torchvision.datasets.MNIST(root = './data', train = False, download = True, transform = transforms.Compose(test_transforms))
+	trainloader = set_unaugmented(get_subset_loader(trainset, batchsize, trainsize, collate_fn = traincollate, loaderargs = loaderargs), unaugmented, backend, traincollate)
+	valloader, testloader = get_subset_loaders(testset, batchsize, [valsize, testsize], shuffle, testcollate, loaderargs = loaderargs)
 	return trainloader, valloader, testloader, datashape, nclasses, np.array(mean), np.array(std)
 
-def imagenet2012_dataloaders(batchsize, trainsize = 1, valsize = 0, testsize = 1, noise = 0, shuffle = False):
+def imagenet2012_dataloaders(batchsize, trainsize = 1, valsize = 0, testsize = 1, noise = 0, shuffle = False, backend = 'torchvision', batchaug = False, loaderargs = None):
 	datashape, mean, std, nclasses = (1, 3, 224, 224), [0.485, 0.456, 0.406], [0.229, 0.224, 0.225], 1000
 	transform = [transforms.ToTensor(), transforms.Normalize(mean, std)]
 	data_aug = [transforms.Resize(256), transforms.RandomCrop(224), transforms.RandomHorizontalFlip()]
 	test_trs = [transforms.Resize(256), transforms.CenterCrop(224)]
-	trainset = torchvision.datasets.ImageFolder(root = '/data/common-data/imagenet_2012/images/train', transform = transforms.Compose(data_aug + transform))
-	valset = torchvision.datasets.ImageFolder(root = '/data/common-data/imagenet_2012/images/val', transform = transforms.Compose(test_trs + transform))
-	trainloader = get_subset_loader(trainset, batchsize, trainsize)
-	valloader, testloader = get_subset_loaders(valset, batchsize, [valsize, testsize], shuffle)
+	traincollate = testcollate = None
+	if batchaug:
+		if backend != 'memmap':
+			raise ValueError('batch augmentation needs fixed-size images, pack imagenet2012 and use the memmap backend')
+		data_aug, test_trs, transform = [], [], []
+		traincollate, testcollate = BatchAugment(224, mean, std).collate, BatchAugment(224, mean, std, crop = 'center', flip = False).collate
+	if backend == 'memmap':
+		trainset, valset = MemmapDataset('imagenet2012', 'train', data_aug + transform), MemmapDataset('imagenet2012', 'val', test_trs + transform)
+	else:
+		trainset = torchvision.datasets.ImageFolder(root = '/data/common-data/imagenet_2012/images/train', transform = transforms.Compose(data_aug + transform))
+		valset = torchvision.datasets.ImageFolder(root = '/data/common-data/imagenet_2012/images/val', transform = transforms.Compose(test_trs + transform))
+	trainloader = set_unaugmented(get_subset_loader(trainset, batchsize, trainsize, collate_fn = traincollate, loaderargs = loaderargs), test_trs + transform, backend, traincollate)
+	valloader, testloader = get_subset_loaders(valset, batchsize, [valsize, testsize], shuffle, testcollate, loaderargs = loaderargs)
 	return trainloader, valloader, testloader, datashape, nclasses, np.array(mean), np.array(std)
 
-def imagenetdownloader_dataloaders(batchsize, trainsize = 0.98, valsize = 0.01, testsize = 0.01, noise = 0, shuffle = True):
+def imagenetdownloader_dataloaders(batchsize, trainsize = 0.98, valsize = 0.01, testsize = 0.01, noise = 0, shuffle = True, backend = 'torchvision', batchaug = False, loaderargs = None):
 	datashape, mean, std, nclasses = (1, 3, 224, 224), [0.47730196, 0.44212466, 0.38233677], [0.26841885, 0.2581342, 0.27384633], 493
 	transform = [transforms.ToTensor(), transforms.Normalize(mean, std)]
 	data_aug = [transforms.Resize(256), transforms.RandomCrop(224), transforms.RandomHorizontalFlip()]
 	test_trs = [transforms.Resize(256), transforms.CenterCrop(224)]
-	trainset = torchvision.datasets.ImageFolder(root = './data/imagenet-downloader/imagenet-downloader-500-500-seed0', transform = transforms.Compose(data_aug + transform))
-	trainloader, valloader, testloader = get_subset_loaders(trainset, batchsize, [trainsize, valsize, testsize], shuffle)
+	traincollate = testcollate = None
+	if batchaug:
+		if backend != 'memmap':
+			raise ValueError('batch augmentation needs fixed-size images, pack imagenetdownloader and use the memmap backend')
+		data_aug, test_trs, transform = [], [], []
+		traincollate, testcollate = BatchAugment(224, mean, std).collate, BatchAugment(224, mean, std, crop = 'center', flip = False).collate
+	if backend == 'memmap':
+		trainset = MemmapDataset('imagenetdownloader', 'train', data_aug + transform)
+	else:
+		trainset = torchvision.datasets.ImageFolder(root = './data/imagenet-downloader/imagenet-downloader-500-500-seed0', transform = transforms.Compose(data_aug + transform))
+	trainloader, valloader, testloader = get_subset_loaders(trainset, batchsize, [trainsize, valsize, testsize], shuffle, traincollate, loaderargs = loaderargs)
+	set_unaugmented(trainloader, test_trs + transform, backend, traincollate)
 	return trainloader, valloader, testloader, datashape, nclasses, np.array(mean), np.array(std)
 
-def tinyimagenet_dataloaders(batchsize, trainsize = 1, valsize = 1, testsize = 1, noise = 0, shuffle = False):
+def tinyimagenet_dataloaders(batchsize, trainsize = 1, valsize = 1, testsize = 1, noise = 0, shuffle = False, backend = 'torchvision', batchaug = False, loaderargs = None):
 	datashape, mean, std, nclasses = (1, 3, 64, 64), [0.4802486, 0.44807222, 0.39754647], [0.2769859, 0.26906505, 0.2820814], 200
 	transform = [transforms.ToTensor(), transforms.Normalize(mean, std)]
 	data_aug = [transforms.RandomCrop(datashape[-1], padding = 4), transforms.RandomHorizontalFlip()]
-	trainset = torchvision.datasets.ImageFolder(root = './data/tiny-imagenet-200/train', transform = transforms.Compose(data_aug + transform))
-	valset = torchvision.datasets.ImageFolder(root = './data/tiny-imagenet-200/val', transform = transforms.Compose(transform))
-	testset = torchvision.datasets.ImageFolder(root = './data/tiny-imagenet-200/test', transform = transforms.Compose(transform))
-	trainloader = get_subset_loader(trainset, batchsize, trainsize, True)
+	traincollate = testcollate = None
+	if batchaug:
+		data_aug, transform = [], [transforms.PILToTensor()]
+		traincollate, testcollate = BatchAugment(datashape[-1], mean, std, 4).collate, BatchAugment(datashape[-1], mean, std, flip = False).collate
+	if backend == 'memmap':
+		trainset, testset = MemmapDataset('tinyimagenet', 'train', data_aug + transform), MemmapDataset('tinyimagenet', 'test', transform)
+	else:
+		trainset = torchvision.datasets.ImageFolder(root = './data/tiny-imagenet-200/train', transform = transforms.Compose(data_aug + transform))
+		valset = torchvision.datasets.ImageFolder(root = './data/tiny-imagenet-200/val', transform = transforms.Compose(transform))
+		testset = torchvision.datasets.ImageFolder(root = './data/tiny-imagenet-200/test', transform = transforms.Compose(transform))
+	trainloader = set_unaugmented(get_subset_loader(trainset, batchsize, trainsize, True, traincollate, loaderargs = loaderargs), transform, backend, traincollate)
 	#valloader = get_subset_loader(valset, batchsize, valsize, shuffle)
 	#testloader = get_subset_loader(testset, batchsize, testsize, shuffle)
-	valloader, testloader = get_subset_loaders(testset, batchsize, [valsize, testsize], shuffle)
+	valloader, testloader = get_subset_loaders(testset, batchsize, [valsize, testsize], shuffle, testcollate, loaderargs = loaderargs)
 	return trainloader, valloader, testloader, datashape, nclasses, np.array(mean), np.array(std)
 
-def get_subset_loader(dataset, batchsize, size, shuffle = True):
+def loader_args(numworkers = 2, pinmemory = False, persistentworkers = False, prefetchfactor = 2):
+	# DataLoader keyword arguments. numworkers = -1 gives one worker per available core, minus the core of the training process
+	numworkers = max(available_cores() - 1, 0) if numworkers < 0 else numworkers
+	args = dict(num_workers = numworkers, pin_memory = bool(pinmemory) and torch.cuda.is_available())
+	if numworkers > 0:
+		args.update(persistent_workers = bool(persistentworkers), prefetch_factor = prefetchfactor)
+	return args
+
+def shared(obj):
+	# obj as drawn by process 0, so that all processes of a distributed run use the same random subsets
+	if not is_distributed():
+		return obj
+	objs = [obj]
+	dist.broadcast_object_list(objs, 0)
+	return objs[0]
+
+class DistributedSubsetSampler(DistributedSampler):
+	# DistributedSampler over the given dataset indices instead of range(len(dataset))
+	def __init__(self, indices, shuffle = True):
+		super(DistributedSubsetSampler, self).__init__(indices, shuffle = shuffle)
+		self.indices = indices
+	def __iter__(self):
+		return (self.indices[i] for i in super(DistributedSubsetSampler, self).__iter__())
+
+def get_subset_loader(dataset, batchsize, size, shuffle = True, collate_fn = None, loaderargs = None):
+	# in a distributed run each process gets its shard of the (subset of the) dataset, batchsize is per process
 	n = len(dataset)
-	sampler = None if size in [None, 'all', 0, 1] else SubsetRandomSampler(np.random.choice(range(n), int(size * n), False))
-	return torchdata.DataLoader(dataset, batch_size = batchsize, shuffle = shuffle, num_workers = 2, sampler = sampler)
+	indices = None if size in [None, 'all', 0, 1] else shared(np.random.choice(range(n), int(size * n), False))
+	if is_distributed():
+		sampler = DistributedSubsetSampler(list(range(n)) if indices is None else indices, shuffle)
+	else:
+		sampler = None if indices is None else SubsetRandomSampler(indices)
+	return torchdata.DataLoader(dataset, batch_size = batchsize, shuffle = shuffle and sampler is None, sampler = sampler, collate_fn = collate_fn, **(loaderargs or loader_args()))
 
-def get_subset_loaders(dataset, batchsize, sizes, shuffle = False):
+def get_subset_loaders(dataset, batchsize, sizes, shuffle = False, collate_fn = None, loaderargs = None):
 	if sum(sizes) > 1:
 		raise ValueError('Sizes cannot sum to more than 1')
 	n, s = len(dataset), len(sizes)
 	indices = list(range(n))
 	np.random.shuffle(indices)
+	indices = shared(indices)
 	cutoffs = [0] + list(np.cumsum([int(np.floor(size * n)) for size in sizes]))
 	idxs = [indices[cutoffs[i]: cutoffs[i + 1]] for i in range(s)]
 	if shuffle:
 		samplers = [SubsetRandomSampler(idx) for idx in idxs]
-		loaders = [torchdata.DataLoader(dataset, batch_size = batchsize, shuffle = False, num_workers = 2, sampler = sampler) for sampler in samplers]
+		loaders = [torchdata.DataLoader(dataset, batch_size = batchsize, shuffle = False, sampler = sampler, collate_fn = collate_fn, **(loaderargs or loader_args())) for sampler in samplers]
 	else:
 		datasets = [Subset(dataset, idx) for idx in idxs]
-		loaders = [torchdata.DataLoader(d, batch_size = batchsize, shuffle = False, num_workers = 2) for d in datasets]
+		loaders = [torchdata.DataLoader(d, batch_size = batchsize, shuffle = False, collate_fn = collate_fn, **(loaderargs or loader_args())) for d in datasets]
 	return loaders
 
-def fake_dataloaders(batchsize, datashape, nclasses):
-	transform = [transforms.ToTensor()]
+def fake_dataloaders(batchsize, datashape, nclasses, loaderargs = None):
+	transform, loaderargs = [transforms.ToTensor()], loaderargs or loader_args()
 	trainset = torchvision.datasets.FakeData(size = 400, image_size = datashape[1:], num_classes = nclasses, transform = transforms.Compose(transform))
-	trainloader = torchdata.DataLoader(trainset, batch_size = batchsize, shuffle = True, num_workers = 2)
+	trainloader = set_unaugmented(torchdata.DataLoader(trainset, batch_size = batchsize, shuffle = True, **loaderargs), transform, 'torchvision')
 	valset = torchvision.datasets.FakeData(size = 200, image_size = datashape[1:], num_classes = nclasses, transform = transforms.Compose(transform))
-	valloader = torchdata.DataLoader(valset, batch_size = batchsize, shuffle = True, num_workers = 2)
+	valloader = torchdata.DataLoader(valset, batch_size = batchsize, shuffle = True, **loaderargs)
 	testset = torchvision.datasets.FakeData(size = 200, image_size = datashape[1:], num_classes = nclasses, transform = transforms.Compose(transform))
-	testloader = torchdata.DataLoader(testset, batch_size = batchsize, shuffle = True, num_workers = 2)
+	testloader = torchdata.DataLoader(testset, batch_size = batchsize, shuffle = True, **loaderargs)
 	return trainloader, valloader, testloader, datashape, nclasses, None, None
 
-def dataloaders(name, batchsize, trainsize = None, valsize = None, testsize = None, noise = 0, shuffle = None):
-	kwargs = {k : v for k, v in dict(batchsize = batchsize, trainsize = trainsize, valsize = valsize, testsize = testsize, noise = noise, shuffle = shuffle).items() if v is not None}
+def dataloaders(name, batchsize, trainsize = None, valsize = None, testsize = None, noise = 0, shuffle = None, backend = 'torchvision', batchaug = False, 
+				numworkers = 2, pinmemory = False, persistentworkers = False, prefetchfactor = 2):
+	loaderargs = loader_args(numworkers, pinmemory, persistentworkers, prefetchfactor)
+	kwargs = {k : v for k, v in dict(batchsize = batchsize, trainsize = trainsize, valsize = valsize, testsize = testsize, noise = noise, shuffle = shuffle, backend = backend, 
+									 batchaug = batchaug, loaderargs = loaderargs).items() if v is not None}
 	if name == 'tinyimagenet':
 		return tinyimagenet_dataloaders(**kwargs)
 	if name == 'imagenet2012':
@@ -153,14 +351,40 @@ def dataloaders(name, batchsize, trainsize = None, valsize = None, testsize = No
 	if name == 'cifar100':
 		return cifar100_dataloaders(**kwargs)
 	if name == 'fake_like_mnist':
-		return fake_dataloaders(batchsize, (1, 1, 28, 28), 10)
+		return fake_dataloaders(batchsize, (1, 1, 28, 28), 10, loaderargs)
 	if name == 'fake_like_cifar10':
-		return fake_dataloaders(batchsize, (1, 3, 32, 32), 10)
+		return fake_dataloaders(batchsize, (1, 3, 32, 32), 10, loaderargs)
 	if name == 'fake_like_cifar100':
-		return fake_dataloaders(batchsize, (1, 3, 32, 32), 100)
+		return fake_dataloaders(batchsize, (1, 3, 32, 32), 100, loaderargs)
 	else:
 		raise ValueError('unknown dataset: ' + name)
 
+def benchmark_loaders(names, batchsize, workers, nbatches = 50, **kwargs):
+	# samples/sec of the train loader for every dataset and worker count, the first batch (worker startup) is not timed
+	for name in names:
+		for numworkers in workers:
+			it = iter(dataloaders(name, batchsize, numworkers = numworkers, **kwargs)[0])
+			next(it)
+			n, t = 0, time.time()
+			for _, (x, _) in zip(range(nbatches), it):
+				n += x.shape[0]
+			print('%s numworkers %d (%d): %.0f samples/sec' % (name, numworkers, loader_args(numworkers)['num_workers'], n / (time.time() - t)))
 
-
-
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-pck", "--pack", default = [], choices = ['mnist', 'cifar10', 'cifar100', 'stl10', 'tinyimagenet', 'imagenet2012', 'imagenetdownloader'], nargs = '*')
+	parser.add_argument("-prt", "--packroot", default = packed_root)
+	parser.add_argument("-bch", "--benchmark", default = [], nargs = '*')
+	parser.add_argument("-nwo", "--numworkers", type = int, default = [4], nargs = '*')
+	parser.add_argument("-bas", "--batchsize", type = int, default = 128)
+	parser.add_argument("-nbt", "--numbatches", type = int, default = 50)
+	parser.add_argument("-bkd", "--backend", default = 'torchvision', choices = ['torchvision', 'memmap'])
+	parser.add_argument("-bta", "--batchaug", type = int, default = 0, choices = [0, 1])
+	parser.add_argument("-pim", "--pinmemory", type = int, default = 0, choices = [0, 1])
+	parser.add_argument("-pew", "--persistentworkers", type = int, default = 0, choices = [0, 1])
+	parser.add_argument("-pff", "--prefetchfactor", type = int, default = 2)
+	args = parser.parse_args()
+	for name in args.pack:
+		pack_dataset(name, args.packroot, loader_args(args.numworkers[0])['num_workers'])
+	benchmark_loaders(args.benchmark, args.batchsize, args.numworkers, args.numbatches, backend = args.backend, batchaug = args.batchaug, pinmemory = args.pinmemory, 
+					  persistentworkers = args.persistentworkers, prefetchfactor = args.prefetchfactor)
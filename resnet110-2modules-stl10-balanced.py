@@ -1,7 +1,7 @@
 # even splits
 import torch, torch.nn as nn, torch.optim as optim, torch.nn.functional as functional, torch.utils.data as torchdata
 from torch.autograd import Variable
-from dataloaders9 import dataloaders
+from dataloaders9 import dataloaders, shared
 from utils7 import *
 from torchsummary import summary
 import time, math, numpy as np, matplotlib.pyplot as plt, argparse, os, collections, sys, inspect, pprint, scipy.stats as st
@@ -13,7 +13,7 @@ class Downsample(nn.Module):
 		self.avg = nn.AvgPool2d(1, 2)   
 	def forward(self, x):   
 		x = self.avg(x)  
-		return torch.cat((x, x.mul(0)), 1)  
+		return functional.pad(x, (0, 0, 0, 0, 0, x.shape[1]))
 
 class ResBlock(nn.Module):
 	def __init__(self, first, infilters, nfilters, stride = 1, downsampling = False):
@@ -26,35 +26,35 @@ class ResBlock(nn.Module):
 		if self.downsampling:
 			self.downsample = Downsample()
 		self.relu = nn.ReLU(inplace = True)
-	def forward(self, x):
+	def forward(self, x, residue = True):
 		if self.first:
 			x = self.encoder(x)
 		z = self.residual(x)
 		if self.downsampling:
 			x = self.downsample(x)	
+		if not residue:
+			return self.relu(z.add_(x)), None
 		return self.relu(x + z), z
 
 class ResModule1(nn.Module):
-	def __init__(self, featureshape, nclasses, clname, apc, initialization):
+	def __init__(self, featureshape, nclasses, clname, apc, initialization, segments = 0):
 		super(ResModule1, self).__init__()
+		self.segments = segments
 		self.blocks = nn.ModuleList([ResBlock(True, 16, 16, 1, False) if i == 0 else ResBlock(False, 16, 16) for i in range(14)])
 		self.blocks.apply(initialization)
 		self.classifier = create_classifier(clname, nclasses, featureshape, apc)
 		self.classifier.apply(initialization)
-	def forward_conv(self, x):
-		rs = []
-		for block in self.blocks:
-			x, r = block(x)
-			rs.append(r)
-		return x, rs
-	def forward(self, x):
-		x, rs = self.forward_conv(x)
+	def forward_conv(self, x, transport = False):
+		return forward_blocks(self.blocks, x, transport, self.segments)
+	def forward(self, x, transport = False):
+		x, cost = self.forward_conv(x, transport)
 		out = self.classifier(x)
-		return out, x, rs
+		return out, x, cost
 
 class ResModule2(nn.Module):
-	def __init__(self, featureshape, nclasses, clname, apc, initialization):
+	def __init__(self, featureshape, nclasses, clname, apc, initialization, segments = 0):
 		super(ResModule2, self).__init__()
+		self.segments = segments
 		blocks1 = [ResBlock(False, 16, 16) for i in range(4)]
 		blocks2 = [ResBlock(False, 16, 32, 2, True) if i == 0 else ResBlock(False, 32, 32) for i in range(18)]
 		blocks3 = [ResBlock(False, 32, 64, 2, True) if i == 0 else ResBlock(False, 64, 64) for i in range(18)]
@@ -63,174 +63,210 @@ class ResModule2(nn.Module):
 		self.classifier = create_classifier(clname, nclasses, featureshape, apc)
 		print('feature shape', featureshape)
 		self.classifier.apply(initialization)
-	def forward_conv(self, x):
-		rs = []
-		for block in self.blocks:
-			x, r = block(x)
-			rs.append(r)
-		return x, rs
-	def forward(self, x):
-		x, rs = self.forward_conv(x)
+	def forward_conv(self, x, transport = False):
+		return forward_blocks(self.blocks, x, transport, self.segments)
+	def forward(self, x, transport = False):
+		x, cost = self.forward_conv(x, transport)
 		out = self.classifier(x)
-		return out, x, rs
+		return out, x, cost
 
+def backbone():
+	# the blocks of all the ResModules in order, to be cut by balanced_partition
+	return resnet_blocks(ResBlock, 16, [(16, 18, 1), (32, 18, 2), (64, 18, 2)])
 
 
-def train_submodel(totrain, modules, optimizers, schedulers, criterion, tra, taus, uza, lml0, lml0type, lml0power, uzt, uzs, ne1, ne2, 
-				   trainloader, valloader, testloader, r = None):
+
+def train_submodel(totrain, modules, optimizers, schedulers, criterion, tra, taus, uza, lml0, lml0type, lml0power, uzt, uzs, ne1, ne2, actcache, actcacheviews, 
+				   trainloader, valloader, testloader, r = None, checkpoint = None):
 	print('\n' + '-' * 64, f'Round {r}' if r is not None else '', 'Submodel', totrain)
 	train_loss, train_accuracy, val_accuracy, it = [], [], [], 0
 	if lml0type == 'decreasing':
 		lml, lmt = lml0 / totrain ** lml0power if totrain > 0 else lml0, totrain ** lml0power / lml0
 	elif lml0type == 'increasing':
 		lml, lmt =  lml0 * totrain ** lml0power, 1 / (lml0 * totrain ** lml0power) if totrain > 0 else 1 / lml0
-	for epoch in range(1, ne1 + totrain * ne2 + 1):
+	start, state = 0, checkpoint.resumed('seq' if r is None else 'mro') if checkpoint is not None else None
+	if state is not None and (state['round'], state['totrain']) == (r, totrain):
+		start, it, lml, lmt, train_loss, val_accuracy = state['epoch'], state['it'], state['lml'], state['lmt'], state['train_loss'], state['val_accuracy']
+	cache = ActivationCache(actcache, actcacheviews) if actcache != 'none' and totrain > 0 else None
+	for epoch in range(start + 1, ne1 + totrain * ne2 + 1):
 		for module in modules:
 			module.train()
-		t1, loss_meter, accuracy_meter = time.time(), AverageMeter(), AverageMeter()
-		for j, (x, y) in enumerate(trainloader):
-			it = it + 1
+		t1, meters = time.time(), MeterArray(1, device)
+		set_sampler_epoch(trainloader, epoch)
+		batches, first = (cache.batches(modules[: totrain], trainloader, device), totrain) if cache is not None else (trainloader, 0)
+		for j, (x, y) in enumerate(batches):
+			it, t0 = it + 1, meters.clock()
 			x, y = x.to(device), y.to(device)
 			z = Variable(x.data, requires_grad = False).detach()
-			for i in range(totrain + 1):
+			for i in range(first, totrain + 1):
 				optimizers[i].zero_grad()
-				out, w, rs = modules[i](z)
+				with autocast(modules[i], device):
+					out, w, transport = modules[i](z, i == totrain and bool(tra or uza))
 				z = Variable(w.data, requires_grad = False).detach()
 				if i == totrain:
-					target = criterion(out, y)
-					if tra or uza :
-						transport = sum([torch.mean(r ** 2) for r in rs]) 
+					target = criterion(out.float(), y)
 					if uza and it % uzs == 0 :
-						lml += uzt * target.item()
-						lmt = 1 / lml
+						lml = lml + uzt * target.detach().double()
+						lmt = (1 / lml).float()
 					loss = target + transport / (2 * taus[i]) if tra else (target + lmt * transport if uza else target)
 					loss.backward()
+					if hasattr(modules[i], 'averager'):
+						modules[i].averager.start()
+						modules[i].averager.finish()
 					optimizers[i].step()
 					if schedulers is not None:
 						schedulers[i].step()
 					_, pred = torch.max(out.data, 1)
-					update_meters(y, pred, target.item(), loss_meter, accuracy_meter)
-		epoch_train_loss, epoch_train_accuracy, epoch_val_accuracy = loss_meter.avg, accuracy_meter.avg, test_submodel(totrain, models, criterion, testloader)
+					meters.update(0, target, pred, y, t0)
+		if hasattr(modules[totrain], 'averager'):
+			modules[totrain].averager.sync_buffers()
+		(epoch_train_loss, ), (epoch_train_accuracy, ) = meters.flush()
+		epoch_val_accuracy = test_submodel(totrain, modules, criterion, testloader, epoch == ne1 + totrain * ne2)
 		print('\n' + '-' * 64, f'Round {r}' if r is not None else '', 'Submodel', totrain, 'Epoch', epoch, 'Took', time.time() - t1, 's')
-		print('Transport', tra, 'tau =', taus[totrain], 'Uzawa', uza, 'lmt =', lmt)
+		print('Transport', tra, 'tau =', taus[totrain], 'Uzawa', uza, 'lmt =', float(lmt))
 		print('Train loss', epoch_train_loss, 'Train accuracy', epoch_train_accuracy, 'Val accuracy', epoch_val_accuracy)
+		print('Precision', getattr(modules[totrain], 'precision', 'fp32'), 'throughput (samples/s)', meters.throughputs()[0])
 		train_loss.append(epoch_train_loss)
 		train_accuracy.append(epoch_train_accuracy)
 		val_accuracy.append(epoch_val_accuracy)
+		if checkpoint is not None and checkpoint.due(epoch, ne1 + totrain * ne2):
+			checkpoint.save(modules, optimizers, schedulers, range(totrain + 1), [totrain], mode = 'seq' if r is None else 'mro', round = r, totrain = totrain, epoch = epoch, 
+							it = it, lml = float(lml), lmt = float(lmt), train_loss = train_loss, val_accuracy = val_accuracy)
+	if cache is not None:
+		cache.report()
+		cache.close()
 	return train_loss, val_accuracy
 
-def train_seq(modules, optimizers, schedulers, criterion, tra, taus, uza, lml0, lml0type, lml0power, uzt, uzs, ne1, ne2, 
-			  trainloader, valloader, testloader, r = None):
+def train_seq(modules, optimizers, schedulers, criterion, tra, taus, uza, lml0, lml0type, lml0power, uzt, uzs, ne1, ne2, actcache, actcacheviews, 
+			  trainloader, valloader, testloader, r = None, checkpoint = None):
 	train_loss, train_accuracy, val_accuracy = [], [], []
-	for totrain in range(len(modules)):
-		trloss, vlacc = train_submodel(totrain, modules, nblocks, optimizers, schedulers, criterion, tra, mean, taus, uza, lml0, lml0type, lml0power, uzt, uzs, ne1, ne2, trainloader, valloader, testloader, r)
+	state = checkpoint.resumed('seq' if r is None else 'mro') if checkpoint is not None else None
+	for totrain in range(state['totrain'] if state is not None and state['round'] == r else 0, len(modules)):
+		trloss, vlacc = train_submodel(totrain, modules, optimizers, schedulers, criterion, tra, taus, uza, lml0, lml0type, lml0power, uzt, uzs, ne1, ne2, actcache, actcacheviews, 
+									   trainloader, valloader, testloader, r, checkpoint)
 	return trloss, vlacc
 
-def test_submodel(totest, modules, criterion, loader):
-	loss_meter, accuracy_meter = AverageMeter(), AverageMeter()
-	for module in modules:
-		module.eval()
-	for j, (x, y) in enumerate(loader):
-		x, y = x.to(device), y.to(device)
-		z = Variable(x.data, requires_grad = False).detach()
-		for i in range(totest + 1) :
-			with torch.no_grad():
-				out, w, rs = modules[i](z)
-				z = Variable(w.data, requires_grad = False).detach()
-				if i == totest:
-					target = criterion(out, y)
-					_, pred = torch.max(out.data, 1)
-					update_meters(y, pred, target.item(), loss_meter, accuracy_meter)
-	return accuracy_meter.avg
+def test_submodel(totest, modules, criterion, loader, report = False):
+	accuracies, _, confusions, firstcorrect = evaluate(modules[: totest + 1], criterion, loader, device)
+	if report:
+		print_evaluation(confusions, firstcorrect)
+	return accuracies[-1]
 
-def train_par(modules, optimizers, schedulers, criterion, tra, taus, uza, lml0, lml0type, lml0power, uzt, uzs, ne0, trainloader, valloader, testloader):
-	t0, nmodules, train_loss, train_accuracy, val_accuracy, it, max_accuracy = time.time(), len(modules), [], [], [], 0, 0
+def train_par(modules, optimizers, schedulers, criterion, tra, taus, uza, lml0, lml0type, lml0power, uzt, uzs, ne0, parmode, replaybuffer, maxstaleness, trainloader, valloader, testloader, checkpoint = None):
+	t0, nmodules, train_loss, train_accuracy, val_accuracy, its, max_accuracy = time.time(), len(modules), [], [], [], [0] * len(modules), 0
 	if lml0type == 'decreasing':
 		lmls, lmts = [lml0 / i ** lml0power if i > 0 else lml0 for i in range(nmodules)], [i ** lml0power / lml0 for i in range(nmodules)] 
 	elif lml0type == 'increasing':
 		lmls, lmts =  [lml0 * i ** lml0power for i in range(nmodules)], [1 / (lml0 * i ** lml0power) if i > 0 else 1 / lml0 for i in range(nmodules)] 
-	print('parallel training for', ne0, 'epochs')
-	for epoch in range(1, ne0 + 1):
+	def step_module(i):
+		optimizers[i].step()
+		if schedulers is not None:
+			schedulers[i].step()
+	def train_module(i, z, y):
+		# in a distributed run the step on the averaged gradients waits for the next batch of the module, so that its all-reduce 
+		# overlaps with the following modules
+		its[i], t0, averager = its[i] + 1, meters.clock(), getattr(modules[i], 'averager', None)
+		if averager is not None and averager.finish():
+			step_module(i)
+		optimizers[i].zero_grad()
+		with autocast(modules[i], device):
+			out, w, transport = modules[i](z, bool(tra or uza))
+		target = criterion(out.float(), y)
+		if uza and its[i] % uzs == 0 :
+			lmls[i] = lmls[i] + uzt * target.detach().double()
+			lmts[i] = (1 / lmls[i]).float()
+		loss = target + transport / (2 * taus[i]) if tra else (target + lmts[i] * transport if uza else target) 
+		loss.backward()
+		if averager is not None:
+			averager.start()
+		else:
+			step_module(i)
+		_, pred = torch.max(out.data, 1)
+		meters.update(i, target, pred, y, t0)
+		return Variable(w.data, requires_grad = False).detach()
+	start, state = 0, checkpoint.resumed('par') if checkpoint is not None else None
+	if state is not None:
+		start, its[:], lmls[:], lmts[:], train_loss, val_accuracy = state['epoch'], state['its'], state['lmls'], state['lmts'], state['train_loss'], state['val_accuracy']
+		max_accuracy = max(val_accuracy, default = 0)
+	print('parallel training for', ne0, 'epochs', {'pipeline': '(pipelined)', 'async': '(asynchronous)'}.get(parmode, ''))
+	for epoch in range(start + 1, ne0 + 1):
 		for module in modules:
 			module.train()
-		t1, loss_meters, accuracy_meters = time.time(), [AverageMeter() for _ in range(nmodules)], [AverageMeter() for _ in range(nmodules)]
-		for j, (x, y) in enumerate(trainloader):
-			it = it + 1
-			x, y = x.to(device), y.to(device)
-			z = Variable(x.data, requires_grad = False).detach()
-			for i, module in enumerate(modules):
-				optimizers[i].zero_grad()
-				out, w, rs = module(z)
-				z = Variable(w.data, requires_grad = False).detach()
-				target = criterion(out, y)
-				if tra or uza :
-					transport = sum([torch.mean(r ** 2) for r in rs]) 
-				if uza and it % uzs == 0 :
-					lmls[i] += uzt * target.item()
-					lmts[i] = 1 / lmls[i]
-				loss = target + transport / (2 * taus[i]) if tra else (target + lmts[i] * transport if uza else target) 
-				loss.backward()
-				optimizers[i].step()
-				if schedulers is not None:
-					schedulers[i].step()
-				_, pred = torch.max(out.data, 1)
-				update_meters(y, pred, target.item(), loss_meters[i], accuracy_meters[i])
-		epoch_val_accuracies = test_par(modules, criterion, testloader)
+		t1, meters = time.time(), MeterArray(nmodules, device)
+		set_sampler_epoch(trainloader, epoch)
+		if parmode == 'pipeline':
+			utilizations, bubbles = train_pipelined([partial(train_module, i) for i in range(nmodules)], trainloader, device)
+		elif parmode == 'async':
+			batches, buffers = train_async([partial(train_module, i) for i in range(nmodules)], trainloader, device, replaybuffer, maxstaleness)
+		else:
+			for j, (x, y) in enumerate(trainloader):
+				x, y = x.to(device), y.to(device)
+				z = Variable(x.data, requires_grad = False).detach()
+				for i in range(nmodules):
+					z = train_module(i, z, y)
+		for i, module in enumerate(modules):
+			if hasattr(module, 'averager'):
+				if module.averager.finish():
+					step_module(i)
+				module.averager.sync_buffers()
+		epoch_val_accuracies = test_par(modules, criterion, testloader, epoch == ne0)
 		max_epoch_val_accuracy = max(epoch_val_accuracies)
 		if max_epoch_val_accuracy > max_accuracy:
 			max_accuracy = max_epoch_val_accuracy
-		epoch_train_losses, epoch_train_accuracies = [loss_meters[i].avg for i in range(nmodules)], [accuracy_meters[i].avg for i in range(nmodules)]
+		epoch_train_losses, epoch_train_accuracies = meters.flush()
 		print('-' * 64, 'Epoch', epoch, 'took', time.time() - t1, 's')
-		print('Transport', tra, 'taus', taus, 'Uzawa', uza, 'lmts', lmts)
+		print('Transport', tra, 'taus', taus, 'Uzawa', uza, 'lmts', [float(lmt) for lmt in lmts])
 		print('Train losses', epoch_train_losses, '\nTrain accuracies', epoch_train_accuracies, '\nVal accuracies', epoch_val_accuracies)
+		print('Precisions', [getattr(module, 'precision', 'fp32') for module in modules], '\nModule throughputs (samples/s)', meters.throughputs())
+		if parmode == 'pipeline':
+			print('Stage utilizations', utilizations, '\nStage bubble times', bubbles)
+		elif parmode == 'async':
+			print('Module batches', batches, '\nReplay buffers', buffers)
 		train_loss.append(np.max(epoch_train_losses))
 		train_accuracy.append(np.max(epoch_train_accuracies))
 		val_accuracy.append(np.max(epoch_val_accuracies))
+		if checkpoint is not None and checkpoint.due(epoch, ne0):
+			checkpoint.save(modules, optimizers, schedulers, mode = 'par', epoch = epoch, its = its, lmls = [float(lml) for lml in lmls], lmts = [float(lmt) for lmt in lmts], train_loss = train_loss, val_accuracy = val_accuracy)
 	print('Max accuracy', max_accuracy)
 	return train_loss, val_accuracy
 
-def test_par(modules, criterion, loader):
-	nmodules = len(modules)
-	loss_meters, accuracy_meters = [AverageMeter() for _ in range(nmodules)], [AverageMeter() for _ in range(nmodules)]
-	for module in modules:
-		module.eval()
-	for j, (x, y) in enumerate(loader):
-		x, y = x.to(device), y.to(device)
-		z = Variable(x.data, requires_grad = False).detach()
-		for i, module in enumerate(modules):
-			with torch.no_grad():
-				out, w, rs = module(z)
-				z = Variable(w.data, requires_grad = False).detach()
-				target = criterion(out, y)
-				_, pred = torch.max(out.data, 1)
-				update_meters(y, pred, target.item(), loss_meters[i], accuracy_meters[i])
-	return [accuracy_meters[i].avg for i in range(nmodules)]
+def test_par(modules, criterion, loader, report = False):
+	accuracies, _, confusions, firstcorrect = evaluate(modules, criterion, loader, device)
+	if report:
+		print_evaluation(confusions, firstcorrect)
+	return accuracies.tolist()
 
-def train_mro(modules, nblocks, optimizers, schedulers, criterion, tra, mean, taus, uza, lml0, lml0type, lml0power, uzt, uzs, ne1, ne2, nrounds, 
-			  trainloader, valloader, testloader):
-	for r in range(1, nrounds + 1):
+def train_mro(modules, optimizers, schedulers, criterion, tra, taus, uza, lml0, lml0type, lml0power, uzt, uzs, ne1, ne2, nrounds, actcache, actcacheviews, 
+			  trainloader, valloader, testloader, checkpoint = None):
+	state = checkpoint.resumed('mro') if checkpoint is not None else None
+	for r in range(state['round'] if state is not None else 1, nrounds + 1):
 		print('\n' + '-' * 64, 'Round', r)
-		trloss, vlacc = train_seq(modules, nblocks, optimizers, schedulers, criterion, tra, mean, taus, uza, lml0, lml0type, lml0power, uzt, uzs, ne1, ne2, 
-								  trainloader, valloader, testloader, r)
+		trloss, vlacc = train_seq(modules, optimizers, schedulers, criterion, tra, taus, uza, lml0, lml0type, lml0power, uzt, uzs, ne1, ne2, actcache, actcacheviews, 
+								  trainloader, valloader, testloader, r, checkpoint)
 	return trloss, vlacc
 
-def train_modulewise(traintype, modules, optimizers, schedulers, criterion, tra, taus, uza, lml0, lml0type, lml0power, uzt, uzs, ne0, ne1, ne2, nrounds, 
-				    trainloader, valloader, testloader):
+def train_modulewise(traintype, modules, optimizers, schedulers, criterion, tra, taus, uza, lml0, lml0type, lml0power, uzt, uzs, ne0, ne1, ne2, nrounds, parmode, replaybuffer, maxstaleness, actcache, actcacheviews, 
+				    trainloader, valloader, testloader, checkpoint = None):
 	if traintype == 'seq':
-		return train_seq(modules, optimizers, schedulers, criterion, tra, taus, uza, lml0, lml0type, lml0power, uzt, uzs, ne1, ne2, 
-						 trainloader, valloader, testloader)
+		return train_seq(modules, optimizers, schedulers, criterion, tra, taus, uza, lml0, lml0type, lml0power, uzt, uzs, ne1, ne2, actcache, actcacheviews, 
+						 trainloader, valloader, testloader, checkpoint = checkpoint)
 	if traintype == 'par':
-		return train_par(modules, optimizers, schedulers, criterion, tra, taus, uza, lml0, lml0type, lml0power, uzt, uzs, ne0, 
-			   		     trainloader, valloader, testloader)
+		return train_par(modules, optimizers, schedulers, criterion, tra, taus, uza, lml0, lml0type, lml0power, uzt, uzs, ne0, parmode, replaybuffer, maxstaleness, 
+			   		     trainloader, valloader, testloader, checkpoint)
 	elif traintype == 'mro':
-		return train_mro(modules, optimizers, schedulers, criterion, tra, taus, uza, lml0, lml0type, lml0power, uzt, uzs, ne1, ne2, nrounds, 
-						 trainloader, valloader, testloader)
+		return train_mro(modules, optimizers, schedulers, criterion, tra, taus, uza, lml0, lml0type, lml0power, uzt, uzs, ne1, ne2, nrounds, actcache, actcacheviews, 
+						 trainloader, valloader, testloader, checkpoint)
 
 
 def modulewise_exp(traintype, featureshape, nclasses, clname, apc, initialization, optimizer, labelsmoothing, learningrate, learningratedecay, beta1, beta2, 
-				   transport, tau, varyingtau, lambdaloss0, lambdaloss0type, lambdaloss0power, uzawatau, uzawasteps, uzawa, nepochs0, nepochs1, nepochs2, nrounds, trainloader, valloader, testloader):
-	ResModule = {0 : ResModule1, 1 : ResModule2}
-	modules = [ResModule[i](featureshape(i), nclasses, clname, apc[i], initialization) for i in range(2)]
+				   transport, tau, varyingtau, lambdaloss0, lambdaloss0type, lambdaloss0power, uzawatau, uzawasteps, uzawa, nepochs0, nepochs1, nepochs2, nrounds, parmode, replaybuffer, maxstaleness, actcache, actcacheviews, earlyexit, partition, recomputesegments, precision, compileshape, channelslast, trainloader, valloader, testloader, 
+				   checkpoint = None, resumemodule = None, exportfile = None, exportthreshold = None):
+	if partition is None:
+		ResModule = {0 : ResModule1, 1 : ResModule2}
+		modules = [ResModule[i](featureshape(i), nclasses, clname, apc[i], initialization, recomputesegments) for i in range(2)]
+	else:
+		blocks, starts = backbone(), np.cumsum([0] + partition)
+		modules = [BlockModule(blocks[starts[i] : starts[i + 1]], featureshape(i), nclasses, clname, apc[i], initialization, recomputesegments) for i in range(len(partition))]
 	if optimizer == 'adam':
 		optimizers = [optim.Adam(filter(lambda p : p.requires_grad, module.parameters()), lr = learningrate, betas = (beta1, beta2)) for module in modules] 
 		schedulers = None
@@ -240,12 +276,21 @@ def modulewise_exp(traintype, featureshape, nclasses, clname, apc, initializatio
 	nmodules = len(modules)
 	taus = [tau / 2] * int(nmodules / 2) + [tau] * int(nmodules / 2) if varyingtau else [tau] * nmodules
 	criterion = nn.CrossEntropyLoss(label_smoothing = labelsmoothing)
-	for i, module in enumerate(modules):
-		if torch.cuda.device_count() > 1:
-			modules[i] = nn.DataParallel(module)
-		modules[i].to(device)
+	for module in modules:
+		module.to(device)
+	set_memory_format(modules, channelslast)
+	set_precision(modules, precision)
+	if checkpoint is not None:
+		checkpoint.load(modules, optimizers, schedulers, resumemodule)
+	distribute(modules)
+	if compileshape is not None:
+		compile_modules(modules, compileshape, ['forward_conv', 'classifier'], [bool(transport or uzawa)] * nmodules, device)
 	train_loss, val_accuracy = train_modulewise(traintype, modules, optimizers, schedulers, criterion, transport, taus, uzawa, lambdaloss0, lambdaloss0type, 
-												lambdaloss0power, uzawatau, uzawasteps, nepochs0, nepochs1, nepochs2, nrounds, trainloader, valloader, testloader)
+												lambdaloss0power, uzawatau, uzawasteps, nepochs0, nepochs1, nepochs2, nrounds, parmode, replaybuffer, maxstaleness, actcache, actcacheviews, trainloader, valloader, testloader, checkpoint)
+	if earlyexit != 'none':
+		early_exit_curve(modules, testloader, device, earlyexit)
+	if exportfile is not None and is_main_process():
+		export_network(modules, next(iter(testloader))[0][: 8], exportfile, exportthreshold, earlyexit if earlyexit != 'none' else 'confidence')
 	for module in modules:
 		del module
 	return train_loss, val_accuracy
@@ -253,7 +298,9 @@ def modulewise_exp(traintype, featureshape, nclasses, clname, apc, initializatio
 
 def experiment(batchsize, traintype, clname, initname, initgain, optimizer, labelsmoothing, learningrate, learningratedecay, beta1, beta2, transport,
 			   tau, varyingtau, lambdaloss0, lambdaloss0type, lambdaloss0power, uzawatau, uzawasteps, nepochs0, nepochs1, nepochs2, nrounds, trainsize, valsize, 
-			   testsize, seed, experiments):
+			   testsize, seed, parmode, replaybuffer, maxstaleness, actcache, actcacheviews, backend, batchaug, 
+			   numworkers, pinmemory, persistentworkers, prefetchfactor, earlyexit, balance, nmodules, recomputesegments, precision, compilemodules, channelslast, experiments, budget = None, checkpoint = None, checkpointevery = 1, resumemodule = None, exportfile = None, 
+			   exportthreshold = None):
 
 	t0 = time.time()
 	dataset = 'stl10'
@@ -263,6 +310,10 @@ def experiment(batchsize, traintype, clname, initname, initgain, optimizer, labe
 		torch.manual_seed(seed)
 		np.random.seed(seed)
 	uzawa = 1 if (uzawatau > 0 and uzawasteps > 0) else 0
+	experiments = experiments and is_main_process()
+	if balance == 'none' and nmodules != 2:
+		raise ValueError('a split into other than 2 modules needs a balanced partition')
+	nepochs0 = budget if budget is not None else nepochs0
 	nepochs = nepochs0 if traintype in ['par', 'e2e'] else nepochs1
 	if varyingtau and tau > 0 and not transport:
 		transport = 1
@@ -277,6 +328,20 @@ def experiment(batchsize, traintype, clname, initname, initgain, optimizer, labe
 		expname = [f'trs{trainsize}', f'tra{transport}', f'uza{uzawa}', f'vta{varyingtau}', f'tau{tau}']
 		if uzawa:
 			expname = expname + [f'lml0{lambdaloss0}', lambdaloss0type, f'lml0p{lambdaloss0power}', f'uzt{uzawatau}', f'uzs{uzawasteps}']
+		if traintype == 'par' and parmode != 'lockstep':
+			expname = expname + [parmode] + ([f'rbs{replaybuffer}', f'mst{maxstaleness}'] if parmode == 'async' else [])
+		if traintype in ['seq', 'mro'] and actcache != 'none':
+			expname = expname + [f'acm{actcache}{actcacheviews}']
+		if balance != 'none':
+			expname = expname + [f'bal{balance}{nmodules}']
+		if recomputesegments > 0:
+			expname = expname + [f'rcs{recomputesegments}']
+		if precision != 'fp32':
+			expname = expname + [precision]
+		if compilemodules:
+			expname = expname + ['cmp']
+		if channelslast:
+			expname = expname + ['chl']
 		stdout0 = sys.stdout
 		d = {'par': str(nepochs0), 'e2e': str(nepochs0), 'seq': str(nepochs1) + '-' + str(nepochs2), 'mro': str(nrounds) + '-' + str(nepochs1) + '-' + str(nepochs2)}
 		expname = ['log', 'res110-2mod', dataset, traintype, d[traintype], clname, initname, f'ing{initgain}', optimizer, f'lrt{learningrate}', 
@@ -289,7 +354,8 @@ def experiment(batchsize, traintype, clname, initname, initgain, optimizer, labe
 	for name in names:
 		print('%s = %s' % (name, values[name]))
 
-	trainloader, valloader, testloader, datashape, nclasses, datamean, datastd = dataloaders(dataset, batchsize, trainsize, valsize, testsize)
+	trainloader, valloader, testloader, datashape, nclasses, datamean, datastd = dataloaders(dataset, batchsize, trainsize, valsize, testsize, backend = backend, batchaug = batchaug, 
+																				   numworkers = numworkers, pinmemory = pinmemory, persistentworkers = persistentworkers, prefetchfactor = prefetchfactor)
 	initialization = partial(initialize, initname, initgain)
 	encoder = nn.Sequential(nn.Conv2d(3, 16, 3, 1, 1, bias = False), nn.BatchNorm2d(16), nn.ReLU(inplace = True))
 	encodingshape =  list(encoder(torch.ones(*datashape)).shape)
@@ -297,11 +363,21 @@ def experiment(batchsize, traintype, clname, initname, initgain, optimizer, labe
 	factor = [1, 4]
 	featureshape = lambda i : [1, nfilters[i], int(encodingshape[2] / factor[i]), int(encodingshape[3] / factor[i])]
 	apc = [16, 8]
+	partition = None
+	if balance != 'none':
+		# the cuts depend on timings that differ between processes, so all of them use those of process 0
+		partition, shapes, apc = shared(balanced_partition(backbone(), nmodules, [batchsize] + list(datashape[1 :]), nclasses, clname, lambda shape : 16 if shape[2] > 24 else 8, balance, device) if is_main_process() else None)
+		featureshape = lambda i : shapes[i]
 	print('train batches', len(trainloader), 'val batches', len(valloader), 'batchsize', batchsize, 'encodingshape', encodingshape, 'featureshape', featureshape, 'apc', apc)
 
 
+	checkpointer = Checkpointer(checkpoint, checkpointevery) if checkpoint is not None else None
+	compileshape = [batchsize] + list(datashape[1 :]) if compilemodules else None
 	trloss, vlacc =  modulewise_exp(traintype, featureshape, nclasses, clname, apc, initialization, optimizer, labelsmoothing, learningrate, learningratedecay, beta1, beta2, transport, tau, varyingtau, 
-									lambdaloss0, lambdaloss0type, lambdaloss0power, uzawatau, uzawasteps, uzawa, nepochs0, nepochs1, nepochs2, nrounds, trainloader, valloader, testloader)
+									lambdaloss0, lambdaloss0type, lambdaloss0power, uzawatau, uzawasteps, uzawa, nepochs0, nepochs1, nepochs2, nrounds, parmode, replaybuffer, maxstaleness, actcache, actcacheviews, earlyexit, partition, recomputesegments, precision, compileshape, channelslast, trainloader, valloader, testloader, checkpoint = checkpointer, resumemodule = resumemodule, 
+									exportfile = exportfile, exportthreshold = exportthreshold)
+	if checkpointer is not None:
+		checkpointer.close()
 	print('Max accuracy', max(vlacc))
 	if experiments and nepochs > 1:
 		print('--- train loss \n', trloss, '\n--- val acc \n', vlacc)
@@ -310,27 +386,28 @@ def experiment(batchsize, traintype, clname, initname, initgain, optimizer, labe
 		sys.stdout = stdout0
 	return trloss, vlacc, time.time() - t0
 
-def experiments(parameters, average):
-	t0, j, f, accs, nparameters = time.time(), 0, 110, [], len(parameters) 
+def experiments(parameters, average, njobs = 1, resultsfile = None, halving = None, eta = 3, checkpoints = None, every = 1):
+	t0, f, nparameters = time.time(), 110, len(parameters)
 	nexperiments = int(np.prod([len(parameters[i][1]) for i in range(nparameters)]))
 	sep = '-' * f 
 	print('\n' + sep, 'res110-2mod.py')
 	print(sep, nexperiments, 'res110-2mod experiments ' + ('to average ' if average else '') + 'over parameters:')
 	pprint.pprint(parameters, width = f, compact = True)
-	for params in product([values for name, values in parameters]) :
-		j += 1
-		print('\n' + sep, 'res110-2mod experiment %d/%d with parameters:' % (j, nexperiments))
-		pprint.pprint([parameters[i][0] + ' = ' + str(params[i]) for i in range(nparameters)], width = f, compact = True)
-		train_loss, val_accuracy, t1 = experiment(*params, True)
-		accs.append(np.max(val_accuracy))
-		print(sep, 'res110-2mod experiment %d/%d over. took %.1f s. total %.1f s' % (j, nexperiments, t1, time.time() - t0))
+	if halving is not None:
+		if set(dict(parameters)['traintype']) != {'par'}:
+			raise ValueError('successive halving is only supported for traintype par')
+		points, rows = halving_sweep(experiment, parameters, halving, max(dict(parameters)['nepochs0']), eta, checkpoints or './checkpoints', every, njobs, resultsfile, device, 'res110-2mod')
+		accs = [max(row['val_accuracy']) for row in rows]
+		print('\nbest configuration', points[int(np.argmax(accs))])
+	else:
+		accs = sweep(experiment, parameters, njobs, resultsfile, device, 'res110-2mod', checkpoints, every)
 	if average:
 		acc = np.mean(accs)
 		confint = st.t.interval(0.95, len(accs) - 1, loc = acc, scale = st.sem(accs))
 		print('\nall val acc', accs)
 		print('\naverage val acc', acc)
 		print('\nconfint', confint)
-	print(('\n' if not average else '') + sep, 'total time for %d experiments: %.1f s' % (j, time.time() - t0))
+	print(('\n' if not average else '') + sep, 'total time for %d experiments: %.1f s' % (len(accs), time.time() - t0))
 
 
 if __name__ == '__main__':
@@ -363,18 +440,52 @@ if __name__ == '__main__':
 	parser.add_argument("-vls", "--valsize", type = float, default = [None], nargs = '*')
 	parser.add_argument("-tss", "--testsize", type = float, default = [None], nargs = '*')
 	parser.add_argument("-see", "--seed", type = int, default = [None], nargs = '*')
+	parser.add_argument("-pam", "--parmode", default = ['lockstep'], choices = ['lockstep', 'pipeline', 'async'], nargs = '*')
+	parser.add_argument("-rbs", "--replaybuffer", type = int, default = [8], nargs = '*')
+	parser.add_argument("-mst", "--maxstaleness", type = int, default = [4], nargs = '*')
+	parser.add_argument("-acm", "--actcache", default = ['none'], choices = ['none', 'ram', 'disk'], nargs = '*')
+	parser.add_argument("-acv", "--actcacheviews", type = int, default = [1], nargs = '*')
+	parser.add_argument("-bkd", "--backend", default = ['torchvision'], choices = ['torchvision', 'memmap'], nargs = '*')
+	parser.add_argument("-bta", "--batchaug", type = int, default = [0], choices = [0, 1], nargs = '*')
+	parser.add_argument("-nwo", "--numworkers", type = int, default = [2], nargs = '*')
+	parser.add_argument("-pim", "--pinmemory", type = int, default = [0], choices = [0, 1], nargs = '*')
+	parser.add_argument("-pew", "--persistentworkers", type = int, default = [0], choices = [0, 1], nargs = '*')
+	parser.add_argument("-pff", "--prefetchfactor", type = int, default = [2], nargs = '*')
+	parser.add_argument("-eem", "--earlyexit", default = ['none'], choices = ['none', 'confidence', 'entropy'], nargs = '*')
+	parser.add_argument("-bal", "--balance", default = ['none'], choices = ['none', 'flops', 'latency', 'memory'], nargs = '*')
+	parser.add_argument("-nmo", "--nmodules", type = int, default = [2], nargs = '*')
+	parser.add_argument("-rcs", "--recomputesegments", type = int, default = [0], nargs = '*')
+	parser.add_argument("-pre", "--precision", default = ['fp32'], choices = ['fp32', 'bf16'], nargs = '*')
+	parser.add_argument("-cmp", "--compilemodules", type = int, default = [0], choices = [0, 1], nargs = '*')
+	parser.add_argument("-chl", "--channelslast", type = int, default = [0], choices = [0, 1], nargs = '*')
 	parser.add_argument("-exp", "--experiments", action = 'store_true')
 	parser.add_argument("-avg", "--averageexperiments", action = 'store_true')
+	parser.add_argument("-njo", "--njobs", type = int, default = 1)
+	parser.add_argument("-rsf", "--resultsfile", default = None)
+	parser.add_argument("-shb", "--halvingbudget", type = int, default = None)
+	parser.add_argument("-she", "--halvingeta", type = int, default = 3)
+	parser.add_argument("-ckf", "--checkpointfolder", default = None)
+	parser.add_argument("-cke", "--checkpointevery", type = int, default = 1)
+	parser.add_argument("-rsm", "--resumemodule", type = int, default = None)
+	parser.add_argument("-exf", "--exportfile", default = None)
+	parser.add_argument("-ext", "--exportthreshold", type = float, default = None)
 	args = parser.parse_args()
 
-	device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+	rank, world = init_distributed()
+	device = torch.device(f'cuda:{os.environ.get("LOCAL_RANK", 0)}' if torch.cuda.is_available() else 'cpu')
+	if world > 1:
+		if args.njobs > 1:
+			raise ValueError('a torchrun launch runs its experiments one at a time, njobs must be 1')
+		if rank > 0:
+			sys.stdout, args.resultsfile = open(os.devnull, 'wt'), None
 
 	if args.experiments or args.averageexperiments:
-		parameters = [(name, values) for name, values in vars(args).items() if name not in ['experiments', 'averageexperiments']]
-		experiments(parameters, args.averageexperiments)
+		parameters = [(name, values) for name, values in vars(args).items() if name not in ['experiments', 'averageexperiments', 'njobs', 'resultsfile', 'halvingbudget', 'halvingeta', 'checkpointfolder', 'checkpointevery', 'resumemodule', 'exportfile', 'exportthreshold']]
+		experiments(parameters, args.averageexperiments, args.njobs, args.resultsfile, args.halvingbudget, args.halvingeta, args.checkpointfolder, args.checkpointevery)
 	else :
-		parameters = [values[0] for name, values in vars(args).items() if name not in ['experiments', 'averageexperiments']]
-		experiment(*parameters, False)
+		parameters = [values[0] for name, values in vars(args).items() if name not in ['experiments', 'averageexperiments', 'njobs', 'resultsfile', 'halvingbudget', 'halvingeta', 'checkpointfolder', 'checkpointevery', 'resumemodule', 'exportfile', 'exportthreshold']]
+		experiment(*parameters, False, checkpoint = args.checkpointfolder, checkpointevery = args.checkpointevery, resumemodule = args.resumemodule, 
+				   exportfile = args.exportfile, exportthreshold = args.exportthreshold)
 
 
 
@@ -61,6 +61,10 @@ def window_reverse(windows, window_size, H, W):
     return x
 
 
+# scaled_dot_product_attention takes the scale keyword as of torch 2.1
+sdpa_available = hasattr(functional, 'scaled_dot_product_attention') and tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (2, 1)
+
+
 class WindowAttention(nn.Module):
     r""" Window based multi-head self attention (W-MSA) module with relative position bias.
     It supports both of shifted and non-shifted window.
@@ -73,9 +77,10 @@ class WindowAttention(nn.Module):
         qk_scale (float | None, optional): Override default qk scale of head_dim ** -0.5 if set
         attn_drop (float, optional): Dropout ratio of attention weight. Default: 0.0
         proj_drop (float, optional): Dropout ratio of output. Default: 0.0
+        attention_backend (str, optional): 'explicit' softmax attention or 'sdpa' for scaled_dot_product_attention. Default: 'explicit'
     """
 
-    def __init__(self, dim, window_size, num_heads, qkv_bias=True, qk_scale=None, attn_drop=0., proj_drop=0.):
+    def __init__(self, dim, window_size, num_heads, qkv_bias=True, qk_scale=None, attn_drop=0., proj_drop=0., attention_backend='explicit'):
 
         super().__init__()
         self.dim = dim
@@ -108,6 +113,27 @@ class WindowAttention(nn.Module):
 
         trunc_normal_(self.relative_position_bias_table, std=.02)
         self.softmax = nn.Softmax(dim=-1)
+        self.cached_bias, self.cached_key = None, None
+        self.attention_backend = attention_backend
+
+    def attention_bias(self, mask=None):
+        """
+        Args:
+            mask: (0/-inf) mask with shape of (num_windows, Wh*Ww, Wh*Ww) or None
+        Returns the relative position bias (nH, Wh*Ww, Wh*Ww), with the mask folded in as (num_windows, nH, Wh*Ww, Wh*Ww). Without grad 
+        through the table (eval, frozen modules) it is cached until the table or the mask change, as told by their version counters.
+        """
+        table = self.relative_position_bias_table
+        cached = not (torch.is_grad_enabled() and table.requires_grad)
+        key = (table.device, table.data_ptr(), table._version) + ((mask.data_ptr(), mask._version) if mask is not None else ())
+        if cached and self.cached_key == key:
+            return self.cached_bias
+        N = self.window_size[0] * self.window_size[1]
+        bias = table[self.relative_position_index.view(-1)].view(N, N, -1).permute(2, 0, 1)  # nH, Wh*Ww, Wh*Ww
+        bias = bias.unsqueeze(0) + mask.unsqueeze(1) if mask is not None else bias.contiguous()
+        if cached:
+            self.cached_bias, self.cached_key = bias, key
+        return bias
 
     def forward(self, x, mask=None):
         """
@@ -119,21 +145,27 @@ class WindowAttention(nn.Module):
         qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
 
+        bias = self.attention_bias(mask)
+        if self.attention_backend == 'sdpa' and sdpa_available:
+            # the bias (and mask) as the additive attn_mask, over (B, nW) windows when masked
+            shape = (B_ // mask.shape[0], mask.shape[0], self.num_heads, N, -1) if mask is not None else (B_, self.num_heads, N, -1)
+            x = functional.scaled_dot_product_attention(q.view(shape), k.view(shape), v.view(shape), attn_mask=bias.to(q.dtype),
+                                                        dropout_p=self.attn_drop.p if self.training else 0., scale=self.scale)
+            x = x.view(B_, self.num_heads, N, -1).transpose(1, 2).reshape(B_, N, C)
+            x = self.proj(x)
+            x = self.proj_drop(x)
+            return x
+
         q = q * self.scale
         attn = (q @ k.transpose(-2, -1))
 
-        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-        attn = attn + relative_position_bias.unsqueeze(0)
-
         if mask is not None:
             nW = mask.shape[0]
-            attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
+            attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + bias
             attn = attn.view(-1, self.num_heads, N, N)
-            attn = self.softmax(attn)
         else:
-            attn = self.softmax(attn)
+            attn = attn + bias
+        attn = self.softmax(attn)
 
         attn = self.attn_drop(attn)
 
@@ -177,12 +209,13 @@ class SwinTransformerBlock(nn.Module):
         act_layer (nn.Module, optional): Activation layer. Default: nn.GELU
         norm_layer (nn.Module, optional): Normalization layer.  Default: nn.LayerNorm
         fused_window_process (bool, optional): If True, use one kernel to fused window shift & window partition for acceleration, similar for the reversed part. Default: False
+        attention_backend (str, optional): 'explicit' softmax attention or 'sdpa' for scaled_dot_product_attention. Default: 'explicit'
     """
 
     def __init__(self, dim, input_resolution, num_heads, window_size=7, shift_size=0,
                  mlp_ratio=4., qkv_bias=True, qk_scale=None, drop=0., attn_drop=0., drop_path=0.,
                  act_layer=nn.GELU, norm_layer=nn.LayerNorm,
-                 fused_window_process=False):
+                 fused_window_process=False, attention_backend='explicit'):
         super().__init__()
         self.dim = dim
         self.input_resolution = input_resolution
@@ -199,7 +232,7 @@ class SwinTransformerBlock(nn.Module):
         self.norm1 = norm_layer(dim)
         self.attn = WindowAttention(
             dim, window_size=to_2tuple(self.window_size), num_heads=num_heads,
-            qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
+            qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop, attention_backend=attention_backend)
 
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
@@ -232,7 +265,7 @@ class SwinTransformerBlock(nn.Module):
         self.register_buffer("attn_mask", attn_mask)
         self.fused_window_process = fused_window_process
 
-    def forward(self, x):
+    def forward(self, x, residue=True):
         H, W = self.input_resolution
         B, L, C = x.shape
         assert L == H * W, "input feature has wrong size"
@@ -274,6 +307,11 @@ class SwinTransformerBlock(nn.Module):
             x = shifted_x
         x = x.view(B, H * W, C)
         r1 = self.drop_path(x)
+        if not residue:
+            # nothing saves r1 or r2 for backward, so the shortcuts can be added to them in place
+            x = r1.add_(shortcut)
+            x = self.drop_path(self.mlp(self.norm2(x))).add_(x)
+            return x, None, None
         x = shortcut + r1
 
         # FFN
@@ -350,6 +388,16 @@ class PatchMerging(nn.Module):
         return flops
 
 
+def forward_swin_blocks(blocks, x, residue=True):
+    residus = []
+    for blk in blocks:
+        x, r1, r2 = blk(x, residue)
+        if residue:
+            residus.append(r1)
+            residus.append(r2)
+    return x, residus
+
+
 class BasicLayer(nn.Module):
     """ A basic Swin Transformer layer for one stage.
 
@@ -367,20 +415,21 @@ class BasicLayer(nn.Module):
         drop_path (float | tuple[float], optional): Stochastic depth rate. Default: 0.0
         norm_layer (nn.Module, optional): Normalization layer. Default: nn.LayerNorm
         downsample (nn.Module | None, optional): Downsample layer at the end of the layer. Default: None
-        use_checkpoint (bool): Whether to use checkpointing to save memory. Default: False.
+        use_checkpoint (bool | int): Number of checkpointed segments the blocks are split in to save memory, True for one per block. Default: False.
         fused_window_process (bool, optional): If True, use one kernel to fused window shift & window partition for acceleration, similar for the reversed part. Default: False
+        attention_backend (str, optional): 'explicit' softmax attention or 'sdpa' for scaled_dot_product_attention. Default: 'explicit'
     """
 
     def __init__(self, dim, input_resolution, depth, num_heads, window_size,
                  mlp_ratio=4., qkv_bias=True, qk_scale=None, drop=0., attn_drop=0.,
                  drop_path=0., norm_layer=nn.LayerNorm, downsample=None, use_checkpoint=False,
-                 fused_window_process=False):
+                 fused_window_process=False, attention_backend='explicit'):
 
         super().__init__()
         self.dim = dim
         self.input_resolution = input_resolution
         self.depth = depth
-        self.use_checkpoint = use_checkpoint
+        self.use_checkpoint = depth if use_checkpoint is True else int(use_checkpoint)
 
         # build blocks
         self.blocks = nn.ModuleList([
@@ -392,7 +441,7 @@ class BasicLayer(nn.Module):
                                  drop=drop, attn_drop=attn_drop,
                                  drop_path=drop_path[i] if isinstance(drop_path, list) else drop_path,
                                  norm_layer=norm_layer,
-                                 fused_window_process=fused_window_process)
+                                 fused_window_process=fused_window_process, attention_backend=attention_backend)
             for i in range(depth)])
 
         # patch merging layer
@@ -401,15 +450,14 @@ class BasicLayer(nn.Module):
         else:
             self.downsample = None
 
-    def forward(self, x):
-        residus = []
-        for blk in self.blocks:
-            if self.use_checkpoint:
-                x, r1, r2 = checkpoint.checkpoint(blk, x)
-            else:
-                x, r1, r2 = blk(x)
-            residus.append(r1)
-            residus.append(r2)
+    def forward(self, x, residue=True):
+        if self.use_checkpoint and torch.is_grad_enabled():
+            residus = []
+            for a, b in segment_bounds(len(self.blocks), self.use_checkpoint):
+                x, rs = checkpoint_segment(forward_swin_blocks, self.blocks[a:b], x, residue)
+                residus.extend(rs)
+        else:
+            x, residus = forward_swin_blocks(self.blocks, x, residue)
         if self.downsample is not None:
             x = self.downsample(x)
         return x, residus
@@ -477,7 +525,7 @@ class PatchEmbed(nn.Module):
 class SwinModule1(nn.Module):
     def __init__(self, clname, img_size = 224, patch_size = 4, in_chans = 3, num_classes = 200, embed_dim = 96, depth = 2, total_depth = 12, num_heads = 3,
                  window_size = 8, mlp_ratio = 4, qkv_bias = True, qk_scale = None, drop_rate = 0., attn_drop_rate = 0., drop_path_rate = 0.1,
-                 norm_layer = nn.LayerNorm, ape = False, patch_norm = True, use_checkpoint = False, fused_window_process = False, **kwargs):
+                 norm_layer = nn.LayerNorm, ape = False, patch_norm = True, use_checkpoint = False, fused_window_process = False, attention_backend = 'explicit', **kwargs):
         super().__init__()
 
         self.num_classes = num_classes
@@ -505,7 +553,8 @@ class SwinModule1(nn.Module):
 
         self.layer = BasicLayer(dim = int(self.num_features / 2), input_resolution = (patches_resolution[0], patches_resolution[1]), depth = depth, num_heads = num_heads, window_size = window_size,
                                 mlp_ratio = mlp_ratio, qkv_bias = qkv_bias, qk_scale = qk_scale, drop = drop_rate, attn_drop = attn_drop_rate, drop_path = dpr[0:2], norm_layer = norm_layer,
-                                downsample = PatchMerging, use_checkpoint = use_checkpoint, fused_window_process = fused_window_process)
+                                downsample = PatchMerging, use_checkpoint = use_checkpoint, fused_window_process = fused_window_process, 
+                                attention_backend = attention_backend)
 
         self.norm = norm_layer(self.num_features)
         self.avgpool = nn.AdaptiveAvgPool1d(1)
@@ -530,12 +579,12 @@ class SwinModule1(nn.Module):
     def no_weight_decay_keywords(self):
         return {'relative_position_bias_table'}
 
-    def forward(self, x):
+    def forward(self, x, residue = True):
         x = self.patch_embed(x)
         if self.ape:
             x = x + self.absolute_pos_embed
         x = self.pos_drop(x)
-        x, residus = self.layer(x)
+        x, residus = self.layer(x, residue)
         out = self.norm(x)  # B L C
         out = self.avgpool(out.transpose(1, 2))  # B C 1
         out = torch.flatten(out, 1)
@@ -543,10 +592,16 @@ class SwinModule1(nn.Module):
         return out, x, residus
 
 
+def drop_stem_keys(state_dict, prefix, *args):
+    # state dicts saved before SwinModule2-4 dropped their unused patch and position embeddings still carry them
+    for key in [key for key in state_dict if key.startswith(prefix + 'patch_embed.') or key == prefix + 'absolute_pos_embed']:
+        del state_dict[key]
+
+
 class SwinModule2(nn.Module):
     def __init__(self, clname, img_size = 224, patch_size = 4, in_chans = 3, num_classes = 200, embed_dim = 96, depth = 2, total_depth = 12, num_heads = 6,
                  window_size = 8, mlp_ratio = 4, qkv_bias = True, qk_scale = None, drop_rate = 0., attn_drop_rate = 0., drop_path_rate = 0.1,
-                 norm_layer = nn.LayerNorm, ape = False, patch_norm = True, use_checkpoint = False, fused_window_process = False, **kwargs):
+                 norm_layer = nn.LayerNorm, ape = False, patch_norm = True, use_checkpoint = False, fused_window_process = False, attention_backend = 'explicit', **kwargs):
         super().__init__()
 
         self.num_classes = num_classes
@@ -556,24 +611,19 @@ class SwinModule2(nn.Module):
         self.num_features = int(embed_dim * 2 ** 2)
         self.mlp_ratio = mlp_ratio
 
-        self.patch_embed = PatchEmbed(img_size = img_size, patch_size = patch_size, in_chans = in_chans, embed_dim = embed_dim, norm_layer = norm_layer if self.patch_norm else None)
-        num_patches = self.patch_embed.num_patches
-        patches_resolution = self.patch_embed.patches_resolution
+        # the patch and position embeddings are only used by SwinModule1, this module takes its tokens
+        img_size, patch_size = to_2tuple(img_size), to_2tuple(patch_size)
+        patches_resolution = [img_size[0] // patch_size[0], img_size[1] // patch_size[1]]
         self.patches_resolution = patches_resolution
-
-        # absolute position embedding
-        if self.ape:
-            self.absolute_pos_embed = nn.Parameter(torch.zeros(1, num_patches, embed_dim))
-            trunc_normal_(self.absolute_pos_embed, std = 0.02)
-
-        self.pos_drop = nn.Dropout(p = drop_rate)
+        self._register_load_state_dict_pre_hook(drop_stem_keys)
 
         # stochastic depth
         dpr = [x.item() for x in torch.linspace(0, drop_path_rate, total_depth)]  
 
         self.layer = BasicLayer(dim = int(self.num_features / 2), input_resolution = (patches_resolution[0] // 2, patches_resolution[1] // 2), depth = depth, num_heads = num_heads, window_size = window_size,
                                 mlp_ratio = mlp_ratio, qkv_bias = qkv_bias, qk_scale = qk_scale, drop = drop_rate, attn_drop = attn_drop_rate, drop_path = dpr[2:4], norm_layer = norm_layer,
-                                downsample = PatchMerging, use_checkpoint = use_checkpoint, fused_window_process = fused_window_process)
+                                downsample = PatchMerging, use_checkpoint = use_checkpoint, fused_window_process = fused_window_process, 
+                                attention_backend = attention_backend)
 
         self.norm = norm_layer(self.num_features)
         self.avgpool = nn.AdaptiveAvgPool1d(1)
@@ -598,8 +648,8 @@ class SwinModule2(nn.Module):
     def no_weight_decay_keywords(self):
         return {'relative_position_bias_table'}
 
-    def forward(self, x):
-        x, residus = self.layer(x)
+    def forward(self, x, residue = True):
+        x, residus = self.layer(x, residue)
         out = self.norm(x)  # B L C
         out = self.avgpool(out.transpose(1, 2))  # B C 1
         out = torch.flatten(out, 1)
@@ -610,7 +660,7 @@ class SwinModule2(nn.Module):
 class SwinModule3(nn.Module):
     def __init__(self, clname, img_size = 224, patch_size = 4, in_chans = 3, num_classes = 200, embed_dim = 96, depth = 6, total_depth = 12, num_heads = 12,
                  window_size = 8, mlp_ratio = 4, qkv_bias = True, qk_scale = None, drop_rate = 0., attn_drop_rate = 0., drop_path_rate = 0.1,
-                 norm_layer = nn.LayerNorm, ape = False, patch_norm = True, use_checkpoint = False, fused_window_process = False, **kwargs):
+                 norm_layer = nn.LayerNorm, ape = False, patch_norm = True, use_checkpoint = False, fused_window_process = False, attention_backend = 'explicit', **kwargs):
         super().__init__()
 
         self.num_classes = num_classes
@@ -620,24 +670,19 @@ class SwinModule3(nn.Module):
         self.num_features = int(embed_dim * 2 ** 3)
         self.mlp_ratio = mlp_ratio
 
-        self.patch_embed = PatchEmbed(img_size = img_size, patch_size = patch_size, in_chans = in_chans, embed_dim = embed_dim, norm_layer = norm_layer if self.patch_norm else None)
-        num_patches = self.patch_embed.num_patches
-        patches_resolution = self.patch_embed.patches_resolution
+        # the patch and position embeddings are only used by SwinModule1, this module takes its tokens
+        img_size, patch_size = to_2tuple(img_size), to_2tuple(patch_size)
+        patches_resolution = [img_size[0] // patch_size[0], img_size[1] // patch_size[1]]
         self.patches_resolution = patches_resolution
-
-        # absolute position embedding
-        if self.ape:
-            self.absolute_pos_embed = nn.Parameter(torch.zeros(1, num_patches, embed_dim))
-            trunc_normal_(self.absolute_pos_embed, std = 0.02)
-
-        self.pos_drop = nn.Dropout(p = drop_rate)
+        self._register_load_state_dict_pre_hook(drop_stem_keys)
 
         # stochastic depth
         dpr = [x.item() for x in torch.linspace(0, drop_path_rate, total_depth)]  
 
         self.layer = BasicLayer(dim = int(self.num_features / 2), input_resolution = (patches_resolution[0] // 4, patches_resolution[1] // 4), depth = depth, num_heads = num_heads, window_size = window_size,
                                 mlp_ratio = mlp_ratio, qkv_bias = qkv_bias, qk_scale = qk_scale, drop = drop_rate, attn_drop = attn_drop_rate, drop_path = dpr[4:10], norm_layer = norm_layer,
-                                downsample = PatchMerging, use_checkpoint = use_checkpoint, fused_window_process = fused_window_process)
+                                downsample = PatchMerging, use_checkpoint = use_checkpoint, fused_window_process = fused_window_process, 
+                                attention_backend = attention_backend)
 
         self.norm = norm_layer(self.num_features)
         self.avgpool = nn.AdaptiveAvgPool1d(1)
@@ -662,8 +707,8 @@ class SwinModule3(nn.Module):
     def no_weight_decay_keywords(self):
         return {'relative_position_bias_table'}
 
-    def forward(self, x):
-        x, residus = self.layer(x)
+    def forward(self, x, residue = True):
+        x, residus = self.layer(x, residue)
         out = self.norm(x)  # B L C
         out = self.avgpool(out.transpose(1, 2))  # B C 1
         out = torch.flatten(out, 1)
@@ -673,7 +718,7 @@ class SwinModule3(nn.Module):
 class SwinModule4(nn.Module):
     def __init__(self, clname, img_size = 224, patch_size = 4, in_chans = 3, num_classes = 200, embed_dim = 96, depth = 2, total_depth = 12, num_heads = 24,
                  window_size = 8, mlp_ratio = 4, qkv_bias = True, qk_scale = None, drop_rate = 0., attn_drop_rate = 0., drop_path_rate = 0.1,
-                 norm_layer = nn.LayerNorm, ape = False, patch_norm = True, use_checkpoint = False, fused_window_process = False, **kwargs):
+                 norm_layer = nn.LayerNorm, ape = False, patch_norm = True, use_checkpoint = False, fused_window_process = False, attention_backend = 'explicit', **kwargs):
         super().__init__()
 
         self.num_classes = num_classes
@@ -683,24 +728,19 @@ class SwinModule4(nn.Module):
         self.num_features = int(embed_dim * 2 ** 3)
         self.mlp_ratio = mlp_ratio
 
-        self.patch_embed = PatchEmbed(img_size = img_size, patch_size = patch_size, in_chans = in_chans, embed_dim = embed_dim, norm_layer = norm_layer if self.patch_norm else None)
-        num_patches = self.patch_embed.num_patches
-        patches_resolution = self.patch_embed.patches_resolution
+        # the patch and position embeddings are only used by SwinModule1, this module takes its tokens
+        img_size, patch_size = to_2tuple(img_size), to_2tuple(patch_size)
+        patches_resolution = [img_size[0] // patch_size[0], img_size[1] // patch_size[1]]
         self.patches_resolution = patches_resolution
-
-        # absolute position embedding
-        if self.ape:
-            self.absolute_pos_embed = nn.Parameter(torch.zeros(1, num_patches, embed_dim))
-            trunc_normal_(self.absolute_pos_embed, std = 0.02)
-
-        self.pos_drop = nn.Dropout(p = drop_rate)
+        self._register_load_state_dict_pre_hook(drop_stem_keys)
 
         # stochastic depth
         dpr = [x.item() for x in torch.linspace(0, drop_path_rate, total_depth)]  
 
         self.layer = BasicLayer(dim = self.num_features, input_resolution = (patches_resolution[0] // 8, patches_resolution[1] // 8), depth = depth, num_heads = num_heads, window_size = window_size,
                                 mlp_ratio = mlp_ratio, qkv_bias = qkv_bias, qk_scale = qk_scale, drop = drop_rate, attn_drop = attn_drop_rate, drop_path = dpr[10:12], norm_layer = norm_layer,
-                                downsample = None, use_checkpoint = use_checkpoint, fused_window_process = fused_window_process)
+                                downsample = None, use_checkpoint = use_checkpoint, fused_window_process = fused_window_process, 
+                                attention_backend = attention_backend)
 
         self.norm = norm_layer(self.num_features)
         self.avgpool = nn.AdaptiveAvgPool1d(1)
@@ -725,8 +765,113 @@ class SwinModule4(nn.Module):
     def no_weight_decay_keywords(self):
         return {'relative_position_bias_table'}
 
+    def forward(self, x, residue = True):
+        x, residus = self.layer(x, residue)
+        out = self.norm(x)  # B L C
+        out = self.avgpool(out.transpose(1, 2))  # B C 1
+        out = torch.flatten(out, 1)
+        out = self.head(out)
+        return out, x, residus
+
+
+
+class SwinStem(nn.Module):
+    # the patch embedding, absolute position embedding and dropout of SwinModule1, carried by the first block of the backbone
+    def __init__(self, img_size = 224, patch_size = 4, in_chans = 3, embed_dim = 96, drop_rate = 0., norm_layer = nn.LayerNorm, ape = False, patch_norm = True):
+        super().__init__()
+        self.patch_embed = PatchEmbed(img_size = img_size, patch_size = patch_size, in_chans = in_chans, embed_dim = embed_dim, norm_layer = norm_layer if patch_norm else None)
+        self.ape = ape
+        if self.ape:
+            self.absolute_pos_embed = nn.Parameter(torch.zeros(1, self.patch_embed.num_patches, embed_dim))
+            trunc_normal_(self.absolute_pos_embed, std = 0.02)
+        self.pos_drop = nn.Dropout(p = drop_rate)
+
     def forward(self, x):
-        x, residus = self.layer(x)
+        x = self.patch_embed(x)
+        if self.ape:
+            x = x + self.absolute_pos_embed
+        return self.pos_drop(x)
+
+
+class SwinBlock(nn.Module):
+    # one SwinTransformerBlock as a backbone block, with the stem before it (first block) and the patch merging after it (last block of a stage).
+    # returns the tokens and the two residues of the block like SwinTransformerBlock, so that forward_swin_blocks runs any run of them
+    def __init__(self, block, stem = None, downsample = None):
+        super().__init__()
+        self.stem, self.block, self.downsample = stem, block, downsample
+        self.out_dim = 2 * block.dim if downsample is not None else block.dim
+
+    def forward(self, x, residue = True):
+        if self.stem is not None:
+            x = self.stem(x)
+        x, r1, r2 = self.block(x, residue)
+        if self.downsample is not None:
+            x = self.downsample(x)
+        return x, r1, r2
+
+
+def backbone(img_size = 224, patch_size = 4, in_chans = 3, embed_dim = 96, depths = [2, 2, 6, 2], num_heads = [3, 6, 12, 24], window_size = 8, mlp_ratio = 4, 
+             qkv_bias = True, qk_scale = None, drop_rate = 0., attn_drop_rate = 0., drop_path_rate = 0.1, norm_layer = nn.LayerNorm, ape = False, patch_norm = True, 
+             fused_window_process = False, attention_backend = 'explicit'):
+    # the blocks of SwinModule1-4 in order, to be cut by balanced_partition
+    dpr = [x.item() for x in torch.linspace(0, drop_path_rate, sum(depths))]
+    resolution, blocks = img_size // patch_size, []
+    for i, (depth, heads) in enumerate(zip(depths, num_heads)):
+        dim = embed_dim * 2 ** i
+        for j in range(depth):
+            block = SwinTransformerBlock(dim = dim, input_resolution = (resolution, resolution), num_heads = heads, window_size = window_size, shift_size = 0 if j % 2 == 0 else window_size // 2, 
+                                         mlp_ratio = mlp_ratio, qkv_bias = qkv_bias, qk_scale = qk_scale, drop = drop_rate, attn_drop = attn_drop_rate, drop_path = dpr[len(blocks)], 
+                                         norm_layer = norm_layer, fused_window_process = fused_window_process, attention_backend = attention_backend)
+            stem = SwinStem(img_size, patch_size, in_chans, embed_dim, drop_rate, norm_layer, ape, patch_norm) if not blocks else None
+            downsample = PatchMerging((resolution, resolution), dim = dim, norm_layer = norm_layer) if j == depth - 1 and i < len(depths) - 1 else None
+            blocks.append(SwinBlock(block, stem, downsample))
+        resolution = resolution // 2 if i < len(depths) - 1 else resolution
+    return blocks
+
+
+class SwinBlockModule(nn.Module):
+    # a module made of any run of backbone blocks, as cut by balanced_partition, with the norm, pooling and linear head of the SwinModules
+    # on its num_features output channels. use_checkpoint is its number of checkpointed segments
+    def __init__(self, blocks, num_features, num_classes = 200, norm_layer = nn.LayerNorm, use_checkpoint = False):
+        super().__init__()
+        self.num_classes = num_classes
+        self.num_features = num_features
+        self.use_checkpoint = int(use_checkpoint)
+        self.blocks = nn.ModuleList(blocks)
+        self.norm = norm_layer(self.num_features)
+        self.avgpool = nn.AdaptiveAvgPool1d(1)
+        self.head = nn.Linear(self.num_features, num_classes)
+
+        self.apply(self._init_weights)
+
+    def _init_weights(self, m):
+        if isinstance(m, nn.Linear):
+            trunc_normal_(m.weight, std = 0.02)
+            if isinstance(m, nn.Linear) and m.bias is not None:
+                nn.init.constant_(m.bias, 0)
+        elif isinstance(m, nn.LayerNorm):
+            nn.init.constant_(m.bias, 0)
+            nn.init.constant_(m.weight, 1.0)
+
+    @torch.jit.ignore
+    def no_weight_decay(self):
+        return {'blocks.0.stem.absolute_pos_embed'}
+
+    @torch.jit.ignore
+    def no_weight_decay_keywords(self):
+        return {'relative_position_bias_table'}
+
+    def forward_layer(self, x, residue = True):
+        if self.use_checkpoint and torch.is_grad_enabled():
+            residus = []
+            for a, b in segment_bounds(len(self.blocks), self.use_checkpoint):
+                x, rs = checkpoint_segment(forward_swin_blocks, self.blocks[a:b], x, residue)
+                residus.extend(rs)
+            return x, residus
+        return forward_swin_blocks(self.blocks, x, residue)
+
+    def forward(self, x, residue = True):
+        x, residus = self.forward_layer(x, residue)
         out = self.norm(x)  # B L C
         out = self.avgpool(out.transpose(1, 2))  # B C 1
         out = torch.flatten(out, 1)
@@ -760,6 +905,7 @@ class SwinTransformer(nn.Module):
         patch_norm (bool): If True, add normalization after patch embedding. Default: True
         use_checkpoint (bool): Whether to use checkpointing to save memory. Default: False
         fused_window_process (bool, optional): If True, use one kernel to fused window shift & window partition for acceleration, similar for the reversed part. Default: False
+        attention_backend (str, optional): 'explicit' softmax attention or 'sdpa' for scaled_dot_product_attention. Default: 'explicit'
     """
 
     def __init__(self, img_size = 224, patch_size = 4, in_chans = 3, num_classes = 1000,
@@ -767,7 +913,7 @@ class SwinTransformer(nn.Module):
                  window_size = 7, mlp_ratio = 4, qkv_bias = True, qk_scale = None,
                  drop_rate = 0., attn_drop_rate = 0., drop_path_rate = 0.1,
                  norm_layer = nn.LayerNorm, ape = False, patch_norm = True,
-                 use_checkpoint = False, fused_window_process = False, **kwargs):
+                 use_checkpoint = False, fused_window_process = False, attention_backend = 'explicit', **kwargs):
         super().__init__()
 
         self.num_classes = num_classes
@@ -811,7 +957,7 @@ class SwinTransformer(nn.Module):
                                norm_layer=norm_layer,
                                downsample=PatchMerging if (i_layer < self.num_layers - 1) else None,
                                use_checkpoint=use_checkpoint,
-                               fused_window_process=fused_window_process)
+                               fused_window_process=fused_window_process, attention_backend=attention_backend)
             self.layers.append(layer)
 
         self.norm = norm_layer(self.num_features)
@@ -871,8 +1017,9 @@ class SwinTransformer(nn.Module):
 class NativeScalerWithGradNormCount:
     state_dict_key = "amp_scaler"
 
-    def __init__(self):
-        self._scaler = torch.cuda.amp.GradScaler()
+    def __init__(self, device='cuda', enabled=True):
+        # loss scaling is only needed for float16 autocast, fp32 and bf16 training run with a disabled (pass-through) scaler
+        self._scaler = torch.amp.GradScaler(torch.device(device).type, enabled=enabled)
 
     def __call__(self, loss, optimizer, clip_grad=None, parameters=None, create_graph=False, update_grad=True):
         self._scaler.scale(loss).backward(create_graph=create_graph)
@@ -921,66 +1068,124 @@ def check_keywords_in_name(name, keywords=()):
             isin = True
     return isin
 
-def train_par(modules, optimizers, schedulers, loss_scalers, clip, criterion, taus, ne0, trainloader, valloader, testloader):
-    t0, nmodules, train_loss, train_accuracy, val_accuracy, it, max_accuracy = time.time(), len(modules), [], [], [], 0, 0
-    print('parallel training for', ne0, 'epochs')
-    for epoch in range(ne0):
+def train_par(modules, optimizers, schedulers, loss_scalers, clip, criterion, taus, ne0, parmode, replaybuffer, maxstaleness, trainloader, valloader, testloader, checkpoint = None):
+    t0, nmodules, train_loss, train_accuracy, val_accuracy, its, max_accuracy = time.time(), len(modules), [], [], [], [0] * len(modules), 0
+    def train_module(i, z, y):
+        t0 = meters.clock()
+        optimizers[i].zero_grad()
+        with autocast(modules[i], device):
+            out, w, rs = modules[i](z, taus[i] > 0)
+        target = criterion(out.float(), y)
+        if taus[i] > 0 :
+            transport = transport_cost(rs)
+        loss = target + transport / (2 * taus[i]) if taus[i] else target 
+        is_second_order = hasattr(optimizers[i], 'is_second_order') and optimizers[i].is_second_order
+        grad_norm = loss_scalers[i](loss, optimizers[i], clip_grad = clip, parameters = modules[i].parameters(), create_graph = is_second_order, update_grad = True)
+        schedulers[i].step_update(its[i])
+        its[i] = its[i] + 1
+        _, pred = torch.max(out.data, 1)
+        meters.update(i, target, pred, y, t0)
+        return Variable(w.data, requires_grad = False).detach()
+    start, state = 0, checkpoint.resumed('par') if checkpoint is not None else None
+    if state is not None:
+        start, its[:], max_accuracy, train_loss, val_accuracy = state['epoch'], state['its'], state['max_accuracy'], state['train_loss'], state['val_accuracy']
+    print('parallel training for', ne0, 'epochs', {'pipeline': '(pipelined)', 'async': '(asynchronous)'}.get(parmode, ''))
+    for epoch in range(start, ne0):
         for module in modules:
             module.train()
-        t1, loss_meters, accuracy_meters = time.time(), [AverageMeter() for _ in range(nmodules)], [AverageMeter() for _ in range(nmodules)]
-        for j, (x, y) in enumerate(trainloader):
-            it = it + 1
-            x, y = x.to(device), y.to(device)
-            z = Variable(x.data, requires_grad = False).detach()
-            for i, module in enumerate(modules):
-                optimizers[i].zero_grad()
-                out, w, rs = module(z)
-                z = Variable(w.data, requires_grad = False).detach()
-                target = criterion(out, y)
-                if taus[i] > 0 :
-                    transport = sum([torch.mean(r ** 2) for r in rs]) 
-                loss = target + transport / (2 * taus[i]) if taus[i] else target 
-                is_second_order = hasattr(optimizers[i], 'is_second_order') and optimizers[i].is_second_order
-                grad_norm = loss_scalers[i](loss, optimizers[i], clip_grad = clip, parameters = module.parameters(), create_graph = is_second_order, update_grad = True)
-                schedulers[i].step_update((epoch * len(trainloader) + j))
-                loss_scale_value = loss_scalers[i].state_dict()["scale"]
-                _, pred = torch.max(out.data, 1)
-                update_meters(y, pred, target.item(), loss_meters[i], accuracy_meters[i])
-        epoch_val_accuracies = test_par(modules, criterion, testloader)
+        t1, meters = time.time(), MeterArray(nmodules, device)
+        if parmode == 'pipeline':
+            utilizations, bubbles = train_pipelined([partial(train_module, i) for i in range(nmodules)], trainloader, device)
+        elif parmode == 'async':
+            batches, buffers = train_async([partial(train_module, i) for i in range(nmodules)], trainloader, device, replaybuffer, maxstaleness)
+        else:
+            for j, (x, y) in enumerate(trainloader):
+                x, y = x.to(device), y.to(device)
+                z = Variable(x.data, requires_grad = False).detach()
+                for i in range(nmodules):
+                    z = train_module(i, z, y)
+        epoch_val_accuracies = test_par(modules, criterion, testloader, epoch == ne0 - 1)
         max_epoch_val_accuracy = max(epoch_val_accuracies)
         if max_epoch_val_accuracy > max_accuracy:
             max_accuracy = max_epoch_val_accuracy
-        epoch_train_losses, epoch_train_accuracies = [loss_meters[i].avg for i in range(nmodules)], [accuracy_meters[i].avg for i in range(nmodules)]
+        epoch_train_losses, epoch_train_accuracies = meters.flush()
         print('-' * 64, 'Epoch', epoch + 1, 'took', time.time() - t1, 's') 
         print('Train losses', epoch_train_losses, '\nTrain accuracies', epoch_train_accuracies, '\nVal accuracies', epoch_val_accuracies)
+        print('Precisions', [getattr(module, 'precision', 'fp32') for module in modules], '\nModule throughputs (samples/s)', meters.throughputs())
+        if parmode == 'pipeline':
+            print('Stage utilizations', utilizations, '\nStage bubble times', bubbles)
+        elif parmode == 'async':
+            print('Module batches', batches, '\nReplay buffers', buffers)
         train_loss.append(np.max(epoch_train_losses))
         train_accuracy.append(np.max(epoch_train_accuracies))
         val_accuracy.append(np.max(epoch_val_accuracies))
+        if checkpoint is not None and checkpoint.due(epoch + 1, ne0):
+            checkpoint.save(modules, optimizers, schedulers, mode = 'par', epoch = epoch + 1, its = its, max_accuracy = max_accuracy, train_loss = train_loss, val_accuracy = val_accuracy)
     print('Max accuracy', max_accuracy)
     return train_loss, val_accuracy
 
-def test_par(modules, criterion, loader):
-    nmodules = len(modules)
-    loss_meters, accuracy_meters = [AverageMeter() for _ in range(nmodules)], [AverageMeter() for _ in range(nmodules)]
-    for module in modules:
-        module.eval()
-    for j, (x, y) in enumerate(loader):
-        x, y = x.to(device), y.to(device)
-        z = Variable(x.data, requires_grad = False).detach()
-        for i, module in enumerate(modules):
-            with torch.no_grad():
-                out, w, rs = module(z)
-                z = Variable(w.data, requires_grad = False).detach()
-                target = criterion(out, y)
-                _, pred = torch.max(out.data, 1)
-                update_meters(y, pred, target.item(), loss_meters[i], accuracy_meters[i])
-    return [accuracy_meters[i].avg for i in range(nmodules)]
-
-
-
-def modulewise_exp(data_shape, num_classes, clname, clip, label_smoothing, window_size, tau, varyingtau, nepochs, trainloader, valloader, testloader):
-    SwinModule = {0 : SwinModule1, 1 : SwinModule2, 2 : SwinModule3, 3 : SwinModule4}
-    modules = [SwinModule[i](clname = clname, img_size = data_shape[-1], in_chans = data_shape[1], num_classes = num_classes, window_size = window_size) for i in range(4)]
+def test_par(modules, criterion, loader, report = False):
+    accuracies, _, confusions, firstcorrect = evaluate(modules, criterion, loader, device)
+    if report:
+        print_evaluation(confusions, firstcorrect)
+    return accuracies.tolist()
+
+
+
+def check_attention_backend(modules, data_shape, tolerance = 1e-4):
+    # runs the modules in eval mode on a fixed random batch with the explicit and the sdpa attention, and falls back to the explicit attention 
+    # if their outputs differ by more than tolerance
+    attentions = [m for module in modules for m in module.modules() if isinstance(m, WindowAttention)]
+    x, outputs = torch.randn(2, *data_shape[1:], generator = torch.Generator().manual_seed(0)).to(device), {}
+    with torch.no_grad():
+        for backend in ['explicit', 'sdpa']:
+            for attention in attentions:
+                attention.attention_backend = backend
+            z, outputs[backend] = x, []
+            for module in modules:
+                out, z, _ = module.eval()(z, False)
+                outputs[backend].append(out)
+    difference = max((a - b).abs().max().item() for a, b in zip(outputs['explicit'], outputs['sdpa']))
+    print('sdpa attention differs from explicit attention by', difference)
+    if difference > tolerance:
+        print('falling back to explicit attention')
+        for attention in attentions:
+            attention.attention_backend = 'explicit'
+
+def test_attention_backends(dim = 32, resolution = 8, window_size = 4, num_heads = 2, batchsize = 3, tolerance = 1e-4):
+    # compares the outputs and the gradients (input, weights and bias table) of the explicit and the sdpa attention on the unmasked windows 
+    # of an unshifted block and the masked windows of a shifted block. returns whether they all match within tolerance
+    generator, match = torch.Generator().manual_seed(0), True
+    for shift in [0, window_size // 2]:
+        block = SwinTransformerBlock(dim, (resolution, resolution), num_heads, window_size, shift).to(device)
+        with torch.no_grad():
+            block.attn.relative_position_bias_table.copy_(torch.randn(block.attn.relative_position_bias_table.shape, generator = generator))
+        x = torch.randn(batchsize * (resolution // window_size) ** 2, window_size ** 2, dim, generator = generator).to(device)
+        dy = torch.randn(x.shape, generator = generator).to(device)
+        results = {}
+        for backend in ['explicit', 'sdpa']:
+            attention = copy.deepcopy(block.attn)
+            attention.attention_backend = backend
+            xb = x.clone().requires_grad_()
+            y = attention(xb, mask = block.attn_mask)
+            y.backward(dy)
+            results[backend] = [y, xb.grad] + [p.grad for p in attention.parameters()]
+        differences = [(a - b).abs().max().item() for a, b in zip(results['explicit'], results['sdpa'])]
+        print('shift', shift, 'masked' if block.attn_mask is not None else 'unmasked', 'output difference', differences[0], 'max gradient difference', max(differences[1:]))
+        match = match and max(differences) <= tolerance
+    print('sdpa attention', 'matches' if match else 'does not match', 'the explicit attention' if sdpa_available else '(unavailable, both ran the explicit attention)')
+    return match
+
+def modulewise_exp(data_shape, num_classes, clname, clip, label_smoothing, window_size, tau, varyingtau, nepochs, parmode, replaybuffer, maxstaleness, earlyexit, partition, recomputesegments, fusedwindowprocess, 
+                   attentionbackend, precision, compilemodules, trainloader, valloader, testloader, checkpoint = None, resumemodule = None):
+    if partition is None:
+        SwinModule = {0 : SwinModule1, 1 : SwinModule2, 2 : SwinModule3, 3 : SwinModule4}
+        modules = [SwinModule[i](clname = clname, img_size = data_shape[-1], in_chans = data_shape[1], num_classes = num_classes, window_size = window_size, 
+                                 use_checkpoint = recomputesegments, fused_window_process = bool(fusedwindowprocess), attention_backend = attentionbackend) for i in range(4)]
+    else:
+        blocks, starts = backbone(img_size = data_shape[-1], in_chans = data_shape[1], window_size = window_size, fused_window_process = bool(fusedwindowprocess), 
+                                  attention_backend = attentionbackend), np.cumsum([0] + partition)
+        modules = [SwinBlockModule(blocks[starts[i] : starts[i + 1]], blocks[starts[i + 1] - 1].out_dim, num_classes, use_checkpoint = recomputesegments) for i in range(len(partition))]
     optimizers, schedulers, loss_scalers = [], [], []
     for module in modules:
         skip = {}
@@ -995,19 +1200,29 @@ def modulewise_exp(data_shape, num_classes, clname, clip, label_smoothing, windo
         warmup_steps = int(20 * len(trainloader))
         scheduler = CosineLRScheduler(optimizer, t_initial = num_steps - warmup_steps, lr_min = 5e-2, warmup_lr_init = 5e-3, warmup_t = warmup_steps, cycle_limit = 1, t_in_epochs = False, warmup_prefix = True)
         schedulers.append(scheduler)
-        loss_scaler = NativeScalerWithGradNormCount()
+        loss_scaler = NativeScalerWithGradNormCount(device, enabled = False)
         loss_scalers.append(loss_scaler)
     nmodules = len(modules)
-    taus = [tau / 2] * int(nmodules / 2) + [tau] * int(nmodules / 2) if varyingtau else [tau] * nmodules
+    taus = [tau / 2] * (nmodules // 2) + [tau] * (nmodules - nmodules // 2) if varyingtau else [tau] * nmodules
     criterion = nn.CrossEntropyLoss(label_smoothing = label_smoothing)
     for module in modules:
         module.to(device)
-    train_loss, val_accuracy = train_par(modules, optimizers, schedulers, loss_scalers, clip, criterion, taus, nepochs, trainloader, valloader, testloader)
+    set_precision(modules, precision)
+    if checkpoint is not None:
+        checkpoint.load(modules, optimizers, schedulers, resumemodule)
+    if attentionbackend == 'sdpa':
+        check_attention_backend(modules, data_shape)
+    if compilemodules:
+        compile_modules(modules, [trainloader.batch_size] + list(data_shape[1:]), ['layer' if partition is None else 'forward_layer', 'head'], [tau > 0 for tau in taus], device)
+    train_loss, val_accuracy = train_par(modules, optimizers, schedulers, loss_scalers, clip, criterion, taus, nepochs, parmode, replaybuffer, maxstaleness, trainloader, valloader, testloader, checkpoint)
+    if earlyexit != 'none':
+        early_exit_curve(modules, testloader, device, earlyexit)
     for module in modules:
         del module
     return train_loss, val_accuracy
 
-def experiment(dataset, batchsize, clname, label_smoothing, window_size, clip, tau, varyingtau, nepochs, seed):
+def experiment(dataset, batchsize, clname, label_smoothing, window_size, clip, tau, varyingtau, nepochs, seed, parmode, replaybuffer, maxstaleness, backend, batchaug, numworkers, pinmemory, persistentworkers, prefetchfactor, earlyexit, recomputesegments, fusedwindowprocess, 
+               attentionbackend, precision, compilemodules, balance, nmodules, checkpointfolder, checkpointevery, resumemodule):
 
     t0 = time.time()
     
@@ -1016,7 +1231,8 @@ def experiment(dataset, batchsize, clname, label_smoothing, window_size, clip, t
         torch.backends.cudnn.benchmark = False
         torch.manual_seed(seed)
         np.random.seed(seed)
-
+    if balance == 'none' and nmodules != 4:
+        raise ValueError('a split into other than 4 modules needs a balanced partition')
     
     
     
@@ -1027,18 +1243,35 @@ def experiment(dataset, batchsize, clname, label_smoothing, window_size, clip, t
     for name in names:
         print('%s = %s' % (name, values[name]))
 
-    train_loader, val_loader, test_loader, data_shape, num_classes, data_mean, data_std = dataloaders(dataset, batchsize)
+    train_loader, val_loader, test_loader, data_shape, num_classes, data_mean, data_std = dataloaders(dataset, batchsize, backend = backend, batchaug = batchaug, numworkers = numworkers, pinmemory = pinmemory, 
+                                                                                                          persistentworkers = persistentworkers, prefetchfactor = prefetchfactor)
     
+    partition = None
+    if balance != 'none':
+        # the swin heads pool the tokens of a module into one, hence apc 1
+        head = lambda shape : SwinBlockModule([], shape[-1], num_classes)
+        partition, shapes, apc = balanced_partition(backbone(img_size = data_shape[-1], in_chans = data_shape[1], window_size = window_size, fused_window_process = bool(fusedwindowprocess), 
+                                                             attention_backend = attentionbackend), nmodules, [batchsize] + list(data_shape[1:]), num_classes, clname, lambda shape : 1, 
+                                                    balance, device, head = head)
+        print('featureshape', shapes, 'apc', apc)
     print('train batches', len(train_loader), 'val batches', len(val_loader), 'batchsize', batchsize)
 
 
-    trloss, vlacc =  modulewise_exp(data_shape, num_classes, clname, clip, label_smoothing, window_size, tau, varyingtau, nepochs, train_loader, val_loader, test_loader)
+    checkpointer = Checkpointer(checkpointfolder, checkpointevery) if checkpointfolder is not None else None
+    trloss, vlacc =  modulewise_exp(data_shape, num_classes, clname, clip, label_smoothing, window_size, tau, varyingtau, nepochs, parmode, replaybuffer, maxstaleness, earlyexit, partition, recomputesegments, 
+                                    fusedwindowprocess, attentionbackend, precision, compilemodules, train_loader, val_loader, test_loader, checkpoint = checkpointer, resumemodule = resumemodule)
+    if checkpointer is not None:
+        checkpointer.close()
 
     
     print('Max accuracy', max(vlacc))
     
 
 if __name__ == '__main__':
+    if sys.argv[1 :] == ['--testattention']:
+        # python swin-4modules.py --testattention checks the sdpa attention against the explicit attention
+        device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+        sys.exit(0 if test_attention_backends() else 1)
     parser = argparse.ArgumentParser()
     parser.add_argument("-dat", "--dataset", required = True, choices = ['mnist', 'cifar10', 'cifar100', 'svhn', 'imagenet2012', 'tinyimagenet', 'imagenetdownloader'])
     parser.add_argument("-bas", "--batchsize", type = int, default = 128)
@@ -1050,6 +1283,26 @@ if __name__ == '__main__':
     parser.add_argument("-vta", "--varyingtau", type = int, default = 0, choices = [0, 1])
     parser.add_argument("-nep", "--numepochs", type = int, default = 300)
     parser.add_argument("-see", "--seed", type = int, default = None)
+    parser.add_argument("-pam", "--parmode", default = 'lockstep', choices = ['lockstep', 'pipeline', 'async'])
+    parser.add_argument("-rbs", "--replaybuffer", type = int, default = 8)
+    parser.add_argument("-mst", "--maxstaleness", type = int, default = 4)
+    parser.add_argument("-bkd", "--backend", default = 'torchvision', choices = ['torchvision', 'memmap'])
+    parser.add_argument("-bta", "--batchaug", type = int, default = 0, choices = [0, 1])
+    parser.add_argument("-nwo", "--numworkers", type = int, default = 2)
+    parser.add_argument("-pim", "--pinmemory", type = int, default = 0, choices = [0, 1])
+    parser.add_argument("-pew", "--persistentworkers", type = int, default = 0, choices = [0, 1])
+    parser.add_argument("-pff", "--prefetchfactor", type = int, default = 2)
+    parser.add_argument("-eem", "--earlyexit", default = 'none', choices = ['none', 'confidence', 'entropy'])
+    parser.add_argument("-rcs", "--recomputesegments", type = int, default = 0)
+    parser.add_argument("-fwp", "--fusedwindowprocess", type = int, default = 0, choices = [0, 1])
+    parser.add_argument("-atb", "--attentionbackend", default = 'explicit', choices = ['explicit', 'sdpa'])
+    parser.add_argument("-pre", "--precision", default = 'fp32', choices = ['fp32', 'bf16'])
+    parser.add_argument("-cmp", "--compilemodules", type = int, default = 0, choices = [0, 1])
+    parser.add_argument("-bal", "--balance", default = 'none', choices = ['none', 'flops', 'latency', 'memory'])
+    parser.add_argument("-nmo", "--nmodules", type = int, default = 4)
+    parser.add_argument("-ckf", "--checkpointfolder", default = None)
+    parser.add_argument("-cke", "--checkpointevery", type = int, default = 1)
+    parser.add_argument("-rsm", "--resumemodule", type = int, default = None)
     args = parser.parse_args()
     device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
     parameters = [values for name, values in vars(args).items()]
@@ -1,4 +1,5 @@
-import torch.nn as nn, os, numpy as np
+import torch, torch.nn as nn, torch.utils.data as torchdata, torch.distributed as dist, os, numpy as np, time, threading, queue, copy, shutil, tempfile, json
+import multiprocessing, concurrent.futures, pprint, hashlib, random, argparse, importlib.util, contextlib
 import matplotlib as mpl, matplotlib.pyplot as plt, matplotlib.cm as cm, math
 from scipy.spatial import ConvexHull
 from sklearn.mixture import GaussianMixture
@@ -7,6 +8,8 @@ from sklearn.neighbors import NearestNeighbors
 from functools import partial
 import torch.nn.functional as functional
 from collections import OrderedDict
+from torch.utils.flop_counter import FlopCounterMode
+from torch.utils.checkpoint import checkpoint as recompute
 
 stack = lambda d :  {name: np.vstack(inp) for name, inp in d.items()}
 get_avg = lambda d, n : [d[i].avg for i in range(n)]
@@ -332,6 +335,434 @@ def initialize(name, gain, module):
 		if hasattr(module, 'bias') and module.bias is not None:
 			nn.init.constant_(module.bias, 0)
 
+class TransportCost(torch.autograd.Function):
+	# cost + mean(r ** 2) as a single dot product, without the r ** 2 temporary. the backward keeps only r and gives 2 r / numel
+	@staticmethod
+	def forward(ctx, cost, r):
+		ctx.save_for_backward(r)
+		flat = r.reshape(-1)
+		return cost + torch.dot(flat, flat).float() / flat.numel()
+	@staticmethod
+	def backward(ctx, grad):
+		r, = ctx.saved_tensors
+		return grad, r * (grad * 2 / r.numel())
+
+def transport_cost(rs, cost = None):
+	# the transport cost sum mean(r ** 2) of the residues rs, added to the running cost
+	for r in rs:
+		cost = TransportCost.apply(cost if cost is not None else r.new_zeros((), dtype = torch.float), r)
+	return cost
+
+def segment_bounds(nblocks, segments):
+	# [start, end) of segments contiguous runs of nblocks blocks, as even as possible
+	segments = min(segments, nblocks)
+	starts = [round(k * nblocks / segments) for k in range(segments + 1)]
+	return list(zip(starts[: -1], starts[1 :]))
+
+@contextlib.contextmanager
+def kept_norm_stats(module):
+	# restores the batchnorm running statistics of module on exit
+	norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+	stats = [[b.clone() for b in (m.running_mean, m.running_var, m.num_batches_tracked)] for m in norms]
+	try:
+		yield
+	finally:
+		with torch.no_grad():
+			for m, (mean, var, n) in zip(norms, stats):
+				m.running_mean.copy_(mean), m.running_var.copy_(var), m.num_batches_tracked.copy_(n)
+
+def checkpoint_segment(run, blocks, *args):
+	# run(blocks, *args) with its activations recomputed in backward instead of kept. the recomputation sees the same rng and leaves the 
+	# batchnorm running statistics as the forward left them
+	calls = []
+	def segment(*args):
+		with kept_norm_stats(blocks) if calls else contextlib.nullcontext():
+			calls.append(1)
+			return run(blocks, *args)
+	return recompute(segment, *args, use_reentrant = False)
+
+def forward_blocks(blocks, x, transport = False, segments = 0):
+	# runs the blocks in order. with transport the cost of their residues is accumulated as the blocks run, otherwise the blocks are run 
+	# without residues, adding the shortcut in place. with segments > 0 and grad enabled, the blocks are split in that many checkpointed 
+	# segments whose activations are recomputed in backward. returns the output and the cost (None without transport)
+	cost = None
+	if segments > 0 and torch.is_grad_enabled():
+		for a, b in segment_bounds(len(blocks), segments):
+			x, c = checkpoint_segment(forward_blocks, blocks[a : b], x, transport)
+			cost = c if cost is None else cost + c
+		return x, cost
+	for block in blocks:
+		x, r = block(x, transport)
+		if transport:
+			cost = transport_cost([r], cost)
+	return x, cost
+
+def benchmark_transport(blocks, x, nreps = 10):
+	# forward + backward through the blocks with their transport cost as the loss, summing mean(r ** 2) over the listed residues against 
+	# the running TransportCost, and without transport with the residues kept against the residue-free blocks: bytes saved for backward, 
+	# peak device memory (cuda only) and median time
+	params = {p.data_ptr() for block in blocks for p in block.parameters()}
+	def listed(x):
+		rs = []
+		for block in blocks:
+			x, *r = block(x)
+			rs.extend(r)
+		return sum([torch.mean(r ** 2) for r in rs])
+	def fused(x):
+		cost = None
+		for block in blocks:
+			x, *r = block(x)
+			cost = transport_cost(r, cost)
+		return cost
+	def kept(x):
+		rs = []
+		for block in blocks:
+			x, r = block(x)
+			rs.append(r)
+		return x.float().mean()
+	def free(x):
+		return forward_blocks(blocks, x)[0].float().mean()
+	for name, f in [('listed transport cost', listed), ('fused transport cost', fused), ('no transport, residues kept', kept), ('no transport, residue-free', free)]:
+		saved, times = {}, []
+		def pack(t):
+			if t.data_ptr() not in params:
+				saved[t.data_ptr()] = t.numel() * t.element_size()
+			return t
+		with torch.autograd.graph.saved_tensors_hooks(pack, lambda t : t):
+			f(x).backward()
+		if x.device.type == 'cuda':
+			torch.cuda.reset_peak_memory_stats(x.device)
+		for rep in range(nreps):
+			synchronize(x.device)
+			t0 = time.time()
+			f(x).backward()
+			synchronize(x.device)
+			times.append(time.time() - t0)
+		peak = '%.1f MB peak' % (torch.cuda.max_memory_allocated(x.device) / 2 ** 20) if x.device.type == 'cuda' else 'no peak on ' + x.device.type
+		print('%s: %.1f MB saved for backward, %s, %.2f ms' % (name, sum(saved.values()) / 2 ** 20, peak, 1000 * np.median(times)))
+
+window_index_cache = {}
+
+def window_indices(H, W, window_size, shift, device):
+	# for the tokens of a H x W grid rolled by shift (as torch.roll on both axes) and split in window_size x window_size windows: the flat 
+	# grid index of each window token, in window order, and its inverse. cached per resolution
+	key = (H, W, window_size, shift, torch.device(device))
+	if key not in window_index_cache:
+		coords = torch.roll(torch.arange(H * W, device = device).view(H, W), (shift, shift), (0, 1))
+		index = coords.view(H // window_size, window_size, W // window_size, window_size).permute(0, 2, 1, 3).reshape(-1)
+		window_index_cache[key] = index, torch.argsort(index)
+	return window_index_cache[key]
+
+class WindowProcess(torch.autograd.Function):
+	# torch.roll by shift then window partition of x (B, H, W, C) into (nW * B, window_size, window_size, C), as a single gather
+	@staticmethod
+	def forward(ctx, x, B, H, W, C, shift, window_size):
+		index, inverse = window_indices(H, W, window_size, shift, x.device)
+		ctx.save_for_backward(inverse)
+		ctx.shape = (B, H, W, C)
+		return x.reshape(B, H * W, C).index_select(1, index).view(-1, window_size, window_size, C)
+	@staticmethod
+	def backward(ctx, grad):
+		inverse, = ctx.saved_tensors
+		B, H, W, C = ctx.shape
+		return grad.reshape(B, H * W, C).index_select(1, inverse).view(B, H, W, C), None, None, None, None, None, None
+
+class WindowProcessReverse(torch.autograd.Function):
+	# window reverse of windows (nW * B, window_size, window_size, C) into (B, H, W, C) then torch.roll by shift, as a single gather
+	@staticmethod
+	def forward(ctx, windows, B, H, W, C, shift, window_size):
+		index, inverse = window_indices(H, W, window_size, -shift, windows.device)
+		ctx.save_for_backward(index)
+		ctx.shape = (B, H, W, C, window_size)
+		return windows.reshape(B, H * W, C).index_select(1, inverse).view(B, H, W, C)
+	@staticmethod
+	def backward(ctx, grad):
+		index, = ctx.saved_tensors
+		B, H, W, C, window_size = ctx.shape
+		return grad.reshape(B, H * W, C).index_select(1, index).view(-1, window_size, window_size, C), None, None, None, None, None, None
+
+def benchmark_window_process(B, H, W, C, window_size, shift, device, nreps = 10):
+	# forward + backward of the shifted window partition and its reverse, torch.roll and permute + contiguous against WindowProcess and 
+	# WindowProcessReverse: max difference and median time
+	def partition(x):
+		x = x.view(B, H // window_size, window_size, W // window_size, window_size, C)
+		return x.permute(0, 1, 3, 2, 4, 5).contiguous().view(-1, window_size, window_size, C)
+	def reverse(windows):
+		x = windows.view(B, H // window_size, W // window_size, window_size, window_size, C)
+		return x.permute(0, 1, 3, 2, 4, 5).contiguous().view(B, H, W, C)
+	def rolled(x):
+		windows = partition(torch.roll(x, (-shift, -shift), (1, 2)))
+		return windows, torch.roll(reverse(windows * 1), (shift, shift), (1, 2))
+	def fused(x):
+		windows = WindowProcess.apply(x, B, H, W, C, -shift, window_size)
+		return windows, WindowProcessReverse.apply(windows * 1, B, H, W, C, shift, window_size)
+	x = torch.randn(B, H, W, C, device = device, requires_grad = True)
+	g = torch.randn(B, H, W, C, device = device)
+	outputs = {}
+	for name, f in [('roll + partition', rolled), ('fused', fused)]:
+		times = []
+		for rep in range(nreps + 1):
+			x.grad = None
+			synchronize(device)
+			t0 = time.time()
+			windows, y = f(x)
+			y.backward(g)
+			synchronize(device)
+			times.append(time.time() - t0)
+		outputs[name] = (windows.detach(), y.detach(), x.grad)
+		print('%s window process (%d, %d, %d, %d) window %d shift %d: %.3f ms' % (name, B, H, W, C, window_size, shift, 1000 * np.median(times[1 :])))
+	print('max difference', max((a - b).abs().max().item() for a, b in zip(*outputs.values())))
+
+class BlockModule(nn.Module):
+	# a module made of any run of backbone blocks (each returning its output and residue) and a classifier, as built by balanced_partition
+	def __init__(self, blocks, featureshape, nclasses, clname, apc, initialization, segments = 0):
+		super(BlockModule, self).__init__()
+		self.segments = segments
+		self.blocks = nn.ModuleList(blocks)
+		self.blocks.apply(initialization)
+		self.classifier = create_classifier(clname, nclasses, featureshape, apc)
+		self.classifier.apply(initialization)
+	def forward_conv(self, x, transport = False):
+		return forward_blocks(self.blocks, x, transport, self.segments)
+	def forward(self, x, transport = False):
+		x, cost = self.forward_conv(x, transport)
+		out = self.classifier(x)
+		return out, x, cost
+
+def resnet_blocks(block, infilters, stages, expansion = 1):
+	# the blocks of a resnet as block(first, infilters, nfilters, stride, downsampling) for stages [(nfilters, nblocks, stride)], the first 
+	# block carrying the encoder
+	blocks = []
+	for nfilters, nblocks, stride in stages:
+		for i in range(nblocks):
+			s = stride if i == 0 else 1
+			blocks.append(block(len(blocks) == 0, infilters, nfilters, s, infilters != expansion * nfilters or s != 1))
+			infilters = expansion * nfilters
+	return blocks
+
+def profile_cost(module, x, nreps = 3):
+	# forward + backward flops, median latency and activation memory (bytes saved for backward, parameters excluded) of a copy of module 
+	# in train mode on the detached batch x. returns the costs and the output
+	module, saved = copy.deepcopy(module).to(x.device).train(), {}
+	params = {p.data_ptr() for p in module.parameters()}
+	def pack(t):
+		if t.data_ptr() not in params:
+			saved[t.data_ptr()] = t.numel() * t.element_size()
+		return t
+	with FlopCounterMode(display = False) as counter, torch.autograd.graph.saved_tensors_hooks(pack, lambda t : t):
+		out = module(x)
+		out = out[0] if isinstance(out, tuple) else out
+		out.float().sum().backward()
+	times = []
+	for rep in range(nreps):
+		synchronize(x.device)
+		t0 = time.time()
+		y = module(x)
+		(y[0] if isinstance(y, tuple) else y).float().sum().backward()
+		synchronize(x.device)
+		times.append(time.time() - t0)
+	return dict(flops = counter.get_total_flops(), latency = float(np.median(times)), memory = sum(saved.values())), out.detach()
+
+def partition_blocks(costs, nmodules, headcosts = None):
+	# contiguous split of the blocks into nmodules minimizing the costliest module, a module costing its blocks plus the classifier head 
+	# after its last block. returns the number of blocks of each module
+	n, headcosts = len(costs), headcosts if headcosts is not None else [0] * len(costs)
+	if not 0 < nmodules <= n:
+		raise ValueError(f'cannot split {n} blocks into {nmodules} modules')
+	prefix = np.concatenate([[0], np.cumsum(costs)])
+	best, cut = np.full((nmodules + 1, n + 1), np.inf), np.zeros((nmodules + 1, n + 1), dtype = int)
+	best[0, 0] = 0
+	for k in range(1, nmodules + 1):
+		for j in range(k, n + 1):
+			for i in range(k - 1, j):
+				c = max(best[k - 1, i], prefix[j] - prefix[i] + headcosts[j - 1])
+				if c < best[k, j]:
+					best[k, j], cut[k, j] = c, i
+	ends = [n]
+	for k in range(nmodules, 1, -1):
+		ends.insert(0, cut[k, ends[0]])
+	return np.diff([0] + ends).tolist()
+
+def balanced_partition(blocks, nmodules, inputshape, nclasses, clname, stageapc, cost = 'latency', device = 'cpu', nreps = 3, head = None):
+	# profiles the blocks in order, and the classifier head that would follow each of them, on a random batch of inputshape, and cuts 
+	# them into nmodules so that the costliest module (by flops, latency or memory) is as cheap as possible: in parallel or pipelined 
+	# block-wise training the slowest module sets the pace. stageapc(featureshape) gives the apc of a head, head(featureshape) the head 
+	# itself when it is not create_classifier's (swin). returns the number of blocks of each module, their featureshapes and apcs
+	head = head or (lambda shape : create_classifier(clname, nclasses, shape, stageapc(shape)))
+	x = torch.randn(*inputshape, generator = torch.Generator().manual_seed(0)).to(device)
+	costs, headcosts, shapes, heads = [], [], [], {}
+	for block in blocks:
+		c, x = profile_cost(block, x, nreps)
+		shape = [1] + list(x.shape[1 :])
+		if tuple(shape) not in heads:
+			heads[tuple(shape)] = profile_cost(head(shape), x, nreps)[0]
+		costs.append(c[cost])
+		headcosts.append(heads[tuple(shape)][cost])
+		shapes.append(shape)
+	sizes = partition_blocks(costs, nmodules, headcosts)
+	ends = np.cumsum(sizes) - 1
+	featureshapes = [shapes[j] for j in ends]
+	modulecosts = [sum(costs[j - size + 1 : j + 1]) + headcosts[j] for size, j in zip(sizes, ends)]
+	print(cost, 'balanced partition into', sizes, 'blocks, module costs', ['%.3g' % c for c in modulecosts], '(even split', 
+		  ['%.3g' % c for c in even_split_costs(costs, headcosts, nmodules)], ')')
+	return sizes, featureshapes, [stageapc(shape) for shape in featureshapes]
+
+def even_split_costs(costs, headcosts, nmodules):
+	ends = [int(round(len(costs) * (k + 1) / nmodules)) for k in range(nmodules)]
+	return [sum(costs[i : j]) + headcosts[j - 1] for i, j in zip([0] + ends[: -1], ends)]
+
+def rng_state():
+	return dict(torch = torch.get_rng_state(), cuda = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None, numpy = np.random.get_state(), 
+				python = random.getstate())
+
+def set_rng_state(state):
+	torch.set_rng_state(state['torch'])
+	if state['cuda'] is not None and torch.cuda.is_available():
+		torch.cuda.set_rng_state_all(state['cuda'])
+	np.random.set_state(state['numpy'])
+	random.setstate(state['python'])
+
+def cpu_copy(state):
+	if torch.is_tensor(state):
+		return state.detach().to('cpu', copy = True)
+	if isinstance(state, dict):
+		return {key : cpu_copy(value) for key, value in state.items()}
+	if isinstance(state, (list, tuple)):
+		return type(state)(cpu_copy(value) for value in state)
+	return copy.deepcopy(state)
+
+def point_folder(folder, point):
+	return os.path.join(folder, hashlib.md5(json.dumps(point, sort_keys = True).encode()).hexdigest())
+
+class Checkpointer(object):
+	# per-module checkpoints in folder: module{i}.pt holds the module, optimizer and scheduler states of module i and run.pt the training position 
+	# and rng states, which every module file also carries as of the last save where module i was trained. save() only copies the states to cpu, 
+	# a writer thread writes the files (each to a temporary file first so a crash never leaves a truncated checkpoint, run.pt last)
+	def __init__(self, folder, every = 1):
+		os.makedirs(folder, exist_ok = True)
+		self.folder, self.every, self.state, self.runs, self.errors = folder, every, None, {}, []
+		self.queue = queue.Queue(maxsize = 2)
+		self.writer = threading.Thread(target = self.write, daemon = True)
+		self.writer.start()
+	def path(self, i = None):
+		return os.path.join(self.folder, 'run.pt' if i is None else f'module{i}.pt')
+	def due(self, epoch, last):
+		return epoch % self.every == 0 or epoch == last
+	def save(self, modules, optimizers, schedulers = None, indices = None, trained = None, **state):
+		# writes the modules in indices (default all), of which those in trained (default all) get the current run state. only process 0 
+		# of a distributed run writes
+		if self.errors:
+			raise self.errors[0]
+		if not is_main_process():
+			return
+		run, indices = cpu_copy(dict(state, rng = rng_state())), indices if indices is not None else range(len(modules))
+		self.runs.update({i : run for i in (trained if trained is not None else indices)})
+		files = [(self.path(i), dict(run = self.runs.get(i, run), **cpu_copy(dict(module = modules[i].state_dict(), optimizer = optimizers[i].state_dict(), 
+				  scheduler = schedulers[i].state_dict() if schedulers is not None else None)))) for i in indices]
+		self.queue.put(files + [(self.path(), run)])
+	def write(self):
+		for files in iter(self.queue.get, None):
+			try:
+				for path, state in files:
+					torch.save(state, path + '.tmp')
+					os.replace(path + '.tmp', path)
+			except Exception as e:
+				self.errors.append(e)
+	def load(self, modules, optimizers, schedulers = None, module = None):
+		# restores the modules from their files and the run state, or only modules up to module and the run state of its last save to restart 
+		# training from module. returns the run state, None if there is nothing to resume. a module named explicitly must have its file
+		if not os.path.exists(self.path(module)):
+			if module is not None:
+				raise FileNotFoundError(f'no checkpoint of module {module} to resume from: {self.path(module)}')
+			return None
+		for i in range(len(modules) if module is None else module + 1):
+			if os.path.exists(self.path(i)):
+				state = torch.load(self.path(i), map_location = 'cpu', weights_only = False)
+				modules[i].load_state_dict(state['module'])
+				optimizers[i].load_state_dict(state['optimizer'])
+				if schedulers is not None and state['scheduler'] is not None:
+					schedulers[i].load_state_dict(state['scheduler'])
+				self.runs[i] = state['run']
+		self.state = torch.load(self.path(module), map_location = 'cpu', weights_only = False)
+		self.state = self.state['run'] if module is not None else self.state
+		set_rng_state(self.state['rng'])
+		print('resumed from', self.path(module), 'at', {key : self.state[key] for key in ['mode', 'round', 'totrain', 'epoch'] if key in self.state})
+		return self.state
+	def resumed(self, mode):
+		return self.state if self.state is not None and self.state['mode'] == mode else None
+	def close(self):
+		self.queue.put(None)
+		self.writer.join()
+		if self.errors:
+			raise self.errors[0]
+
+def sweep_point(experiment, params, device, nthreads, extras):
+	torch.set_num_threads(nthreads)
+	experiment.__globals__['device'] = torch.device(device)
+	train_loss, val_accuracy, t = experiment(*params, True, **extras)
+	return [float(l) for l in train_loss], [float(a) for a in val_accuracy], t
+
+def sweep_points(experiment, names, points, njobs = 1, resultsfile = None, device = 'cpu', label = 'experiment', extras = None):
+	# runs experiment(*point, True, **extras(point)) for every point over njobs processes that split the available cores (and round-robin over the gpus). 
+	# every finished run is appended to the jsonl resultsfile, runs already in it (same point and budget) are skipped. returns the rows in points order
+	sep, t0, extras = '-' * 110, time.time(), extras or (lambda point : {})
+	key, done = lambda point, budget : json.dumps(dict(parameters = point, budget = budget), sort_keys = True), {}
+	if resultsfile is not None and os.path.exists(resultsfile):
+		with open(resultsfile) as f:
+			for line in f:
+				row = json.loads(line)
+				done[key(row['parameters'], row.get('budget'))] = row
+	todo = [point for point in points if key(point, extras(point).get('budget')) not in done]
+	if len(todo) < len(points):
+		print(sep, len(points) - len(todo), 'of', len(points), label, 'experiments already in', resultsfile)
+	njobs = max(1, min(njobs, len(todo)))
+	nthreads = max(1, available_cores() // njobs)
+	devices = [f'cuda:{k}' for k in range(torch.cuda.device_count())] if torch.device(device).type == 'cuda' else [str(device)]
+	tasks = [(experiment, [point[name] for name in names], devices[k % len(devices)], nthreads, extras(point)) for k, point in enumerate(todo)]
+	if njobs == 1:
+		results = ((k, sweep_point(*task)) for k, task in enumerate(tasks))
+	else:
+		pool = concurrent.futures.ProcessPoolExecutor(njobs, mp_context = multiprocessing.get_context('spawn'))
+		futures = {pool.submit(sweep_point, *task) : k for k, task in enumerate(tasks)}
+		results = ((futures[future], future.result()) for future in concurrent.futures.as_completed(futures))
+	for j, (k, (train_loss, val_accuracy, t1)) in enumerate(results):
+		budget = extras(todo[k]).get('budget')
+		row = dict(parameters = todo[k], budget = budget, train_loss = train_loss, val_accuracy = val_accuracy, time = t1)
+		done[key(todo[k], budget)] = row
+		if resultsfile is not None:
+			with open(resultsfile, 'a') as f:
+				f.write(json.dumps(row) + '\n')
+		print('\n' + sep, '%s experiment %d/%d over (%d jobs, %d threads each). took %.1f s. total %.1f s' % (label, j + 1, len(todo), njobs, nthreads, t1, time.time() - t0))
+		pprint.pprint([name + ' = ' + str(todo[k][name]) for name in names], width = 110, compact = True)
+	if njobs > 1:
+		pool.shutdown()
+	return [done[key(point, extras(point).get('budget'))] for point in points]
+
+def sweep(experiment, parameters, njobs = 1, resultsfile = None, device = 'cpu', label = 'experiment', folder = None, every = 1):
+	# runs the grid of parameters [(name, values)] and returns the max val accuracy of each grid point. with a folder every grid point checkpoints 
+	# to (and resumes from) its own subfolder
+	names = [name for name, _ in parameters]
+	points = [dict(zip(names, params)) for params in product([values for _, values in parameters])]
+	extras = (lambda point : dict(checkpoint = point_folder(folder, point), checkpointevery = every)) if folder is not None else None
+	return [max(row['val_accuracy']) for row in sweep_points(experiment, names, points, njobs, resultsfile, device, label, extras)]
+
+def halving_sweep(experiment, parameters, budget, maxbudget, eta = 3, folder = './checkpoints', every = 1, njobs = 1, resultsfile = None, device = 'cpu', label = 'experiment'):
+	# successive halving over the grid of parameters: every configuration trains for budget epochs, the best 1 / eta by last-epoch val accuracy 
+	# continue from their checkpoints with eta times the budget, until maxbudget. returns the surviving configurations and their rows. a point 
+	# without seed gets one derived from its parameters, so that every rung draws the same train subset and val/test split for it
+	names, sep = [name for name, _ in parameters], '-' * 110
+	points = [dict(zip(names, params)) for params in product([values for _, values in parameters])]
+	points = [dict(point, seed = int(hashlib.md5(json.dumps(point, sort_keys = True).encode()).hexdigest()[: 8], 16)) if point.get('seed', 0) is None else point 
+			  for point in points]
+	while True:
+		rows = sweep_points(experiment, names, points, njobs, resultsfile, device, label, lambda point : dict(budget = budget, checkpoint = point_folder(folder, point), checkpointevery = every))
+		order = np.argsort([-row['val_accuracy'][-1] for row in rows], kind = 'stable')
+		print('\n' + sep, label, 'rung with budget', budget, 'epochs:', len(points), 'configurations, last val accuracies', sorted([row['val_accuracy'][-1] for row in rows], reverse = True))
+		if budget >= maxbudget:
+			return points, rows
+		points = [points[i] for i in order[: max(1, len(points) // eta)]]
+		budget = maxbudget if len(points) == 1 else min(budget * eta, maxbudget)
+
 def product(iterables):
 	if len(iterables) == 0 :
 		yield ()
@@ -359,6 +790,634 @@ class AverageMeter(object):
 		self.count += num
 		self.avg = self.sum / self.count
 
+def set_precision(modules, precision):
+	# the precision policy of each module: 'fp32', or 'bf16' to run its forward under bfloat16 autocast on any device. parameters, gradients, 
+	# optimizer states and losses stay in fp32, so no loss scaling is needed
+	for module in modules:
+		module.precision = precision
+
+def set_memory_format(modules, channelslast):
+	# with channelslast, the parameters of each module are converted to NHWC once, and its input on entry when it is not NHWC already (the
+	# batches of the loader), so that the activations stay NHWC through the blocks and across the detached hand-offs between modules
+	if not channelslast:
+		return
+	def to_channels_last(module, args):
+		if args[0].dim() == 4 and not args[0].is_contiguous(memory_format = torch.channels_last):
+			return (args[0].contiguous(memory_format = torch.channels_last), ) + args[1 :]
+	for module in modules:
+		module.to(memory_format = torch.channels_last)
+		module.register_forward_pre_hook(to_channels_last)
+
+def autocast(module, device):
+	# the autocast context of the precision policy of module
+	return torch.autocast(torch.device(device).type, dtype = torch.bfloat16, enabled = getattr(module, 'precision', 'fp32') == 'bf16')
+
+def compile_modules(modules, shape, parts, flags, device, cachefolder = None, nreps = 5):
+	# compiles the parts of each module with torch.compile, the names of a method (forward_conv) or of a submodule (classifier) whose forward
+	# is compiled, so that state dicts keep their keys. module i is warmed up on a random batch of the given shape before training, in both
+	# variants the run uses: the training step module(x, flags[i]) forward and backward, and the no_grad evaluation pass module(x) in eval
+	# mode, whose features are chained to the next module. TORCHINDUCTOR_CACHE_DIR is set for the rest of the run to a folder of cachefolder
+	# keyed by the modules, the parts, the flags, the input shape, the precisions and the torch version, so that the recompiles of training
+	# (e.g. for a smaller last batch) also go there, and a repeated run loads them instead of compiling. a module is reported as cached when
+	# its warm-up only hit the inductor cache. dynamo errors are suppressed during the warm-up only, so a module that fails to compile stays
+	# eager, while a later recompile that fails raises. prints and returns the eager and compiled step times of each module
+	import torch._dynamo
+	from torch._dynamo.utils import counters
+	cachefolder = cachefolder or os.path.join(tempfile.gettempdir(), 'modulewise-compile')
+	key = hashlib.sha1(repr(([(repr(module), getattr(module, 'precision', 'fp32')) for module in modules], parts, list(flags), list(shape), 
+		torch.__version__)).encode()).hexdigest()[: 16]
+	os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.join(cachefolder, key)
+	print('inductor cache', os.environ['TORCHINDUCTOR_CACHE_DIR'])
+	x, report, suppress = torch.randn(*shape, generator = torch.Generator().manual_seed(0)).to(device), [], torch._dynamo.config.suppress_errors
+	def step(module, x, flag):
+		with autocast(module, device):
+			out, w, _ = module(x, flag)
+		out.float().sum().backward()
+		synchronize(device)
+		return w
+	def timed(module, x, flag):
+		times = []
+		for _ in range(nreps):
+			t = time.time()
+			step(module, x, flag)
+			times.append(time.time() - t)
+		return float(np.median(times))
+	def evaluate(module, x):
+		training = module.training
+		module.eval()
+		with torch.no_grad(), autocast(module, device):
+			_, w, _ = module(x)
+		module.train(training)
+		return w
+	try:
+		torch._dynamo.config.suppress_errors = True
+		with torch.random.fork_rng(devices = [device] if torch.device(device).type == 'cuda' else []):
+			for i, module in enumerate(modules):
+				training = module.training
+				with kept_norm_stats(module):
+					eager = timed(module, x, flags[i])
+					hits, misses = counters['inductor']['fxgraph_cache_hit'], counters['inductor']['fxgraph_cache_miss']
+					try:
+						for part in parts:
+							target = getattr(module, part)
+							if isinstance(target, nn.Module):
+								target.forward = torch.compile(target.forward)
+							else:
+								setattr(module, part, torch.compile(target))
+						t = time.time()
+						step(module, x, flags[i])
+						evaluate(module, x)
+						compiletime, compiled, error = time.time() - t, timed(module, x, flags[i]), None
+					except Exception as e:
+						module.train(training)
+						for part in parts:
+							if isinstance(getattr(module, part, None), nn.Module):
+								getattr(module, part).__dict__.pop('forward', None)
+							else:
+								module.__dict__.pop(part, None)
+						compiletime, compiled, error = 0, eager, e
+					hits, misses = counters['inductor']['fxgraph_cache_hit'] - hits, counters['inductor']['fxgraph_cache_miss'] - misses
+					w = evaluate(module, x)
+					module.zero_grad(set_to_none = True)
+				cached = hits > 0 and misses == 0
+				report.append(dict(eager = eager, compiled = compiled, speedup = eager / compiled, compiletime = compiletime, cached = cached, error = error))
+				print('module %d: %s, eager %.2f ms, compiled %.2f ms, speedup %.2f, compile %.1f s%s' % (i, 'eager fallback (%s)' % error if error else 'compiled',
+					  1000 * eager, 1000 * compiled, eager / compiled, compiletime, ' (cached)' if cached else ''))
+				x = w.detach()
+	finally:
+		torch._dynamo.config.suppress_errors = suppress
+	return report
+
+class MeterArray(object):
+	# running loss and accuracy of n modules kept as sums on the device, so that update never waits for the device. flush returns the 
+	# average losses and accuracies since the last flush, with a single copy to the host. with the start t0 = clock() of the step, update also 
+	# counts its time for throughputs, the samples per second of each module since the last call: wall time on the cpu, and on cuda the time 
+	# between events recorded on the stream, read by throughputs so that update does not wait for the device either
+	def __init__(self, n, device):
+		self.sums = torch.zeros(n, 3, dtype = torch.float64, device = device)
+		self.times, self.samples, self.device, self.events = np.zeros(n), np.zeros(n), device, [[] for _ in range(n)]
+		self.cuda = torch.device(device).type == 'cuda'
+	def clock(self):
+		if not self.cuda:
+			return time.time()
+		event = torch.cuda.Event(enable_timing = True)
+		event.record()
+		return event
+	def update(self, i, loss, pred, y, t0 = None):
+		num = len(y)
+		self.sums[i, 0] += loss.detach() * num
+		self.sums[i, 1] += (pred == y).sum()
+		self.sums[i, 2] += num
+		if t0 is not None:
+			if self.cuda:
+				self.events[i].append((t0, self.clock()))
+			else:
+				self.times[i] += time.time() - t0
+			self.samples[i] += num
+	def flush(self):
+		sums = self.sums.to('cpu', copy = True)
+		self.sums.zero_()
+		if is_distributed():
+			dist.all_reduce(sums)
+		return (sums[:, 0] / sums[:, 2]).tolist(), (sums[:, 1] / sums[:, 2]).tolist()
+	def throughputs(self):
+		if self.cuda:
+			synchronize(self.device)
+			for i, events in enumerate(self.events):
+				self.times[i] += sum(start.elapsed_time(end) for start, end in events) / 1000
+				events.clear()
+		throughputs = np.round(self.samples / np.maximum(self.times, 1e-9), 1).tolist()
+		self.times[:], self.samples[:] = 0, 0
+		return throughputs
+
+def init_distributed(backend = 'gloo'):
+	# joins the process group of a torchrun launch (WORLD_SIZE > 1) and splits the cores of the machine between its processes. returns the 
+	# rank and the world size, (0, 1) when not launched by torchrun
+	if int(os.environ.get('WORLD_SIZE', 1)) > 1 and not dist.is_initialized():
+		dist.init_process_group(backend)
+		torch.set_num_threads(max(1, available_cores() // int(os.environ.get('LOCAL_WORLD_SIZE', dist.get_world_size()))))
+	return (dist.get_rank(), dist.get_world_size()) if dist.is_initialized() else (0, 1)
+
+def is_distributed():
+	return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+def is_main_process():
+	return not is_distributed() or dist.get_rank() == 0
+
+class GradientAverager(object):
+	# data parallelism of one module over the processes of a distributed run, in a process group of its own so that each module all-reduces 
+	# independently (and from its own thread when pipelined). the parameters and buffers of process 0 are broadcast at creation. start 
+	# launches the all-reduce of the flattened gradients after backward without waiting, finish waits for it and writes the averages back 
+	# before the optimizer step. a module whose step is deferred to its next batch overlaps its communication with the next modules' compute
+	def __init__(self, module):
+		self.module, self.group, self.work = module, dist.new_group(), None
+		self.params = [p for p in module.parameters() if p.requires_grad]
+		with torch.no_grad():
+			for t in module.state_dict().values():
+				dist.broadcast(t, 0, group = self.group)
+	def start(self):
+		self.flat = torch.cat([(p.grad if p.grad is not None else torch.zeros_like(p)).reshape(-1) for p in self.params])
+		self.work = dist.all_reduce(self.flat, group = self.group, async_op = True)
+	def finish(self):
+		# returns whether there was an all-reduce to finish
+		if self.work is None:
+			return False
+		self.work.wait()
+		self.flat /= dist.get_world_size(self.group)
+		offset, self.work = 0, None
+		for p in self.params:
+			if p.grad is None:
+				p.grad = torch.zeros_like(p)
+			p.grad.copy_(self.flat[offset : offset + p.numel()].view_as(p))
+			offset += p.numel()
+		return True
+	def sync_buffers(self):
+		# the batchnorm running statistics of process 0, so that all processes evaluate the same module
+		with torch.no_grad():
+			for b in self.module.buffers():
+				dist.broadcast(b, 0, group = self.group)
+
+def distribute(modules):
+	# gives each module its GradientAverager in a distributed run
+	if is_distributed():
+		for module in modules:
+			module.averager = GradientAverager(module)
+
+def set_sampler_epoch(loader, epoch):
+	# reshuffles the shards of a distributed sampler
+	if hasattr(getattr(loader, 'sampler', None), 'set_epoch'):
+		loader.sampler.set_epoch(epoch)
+
+def available_cores():
+	return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+
+def train_pipelined(steps, loader, device, queuesize = 2, nthreads = None):
+	# steps[i](z, y) trains module i on one batch and returns its detached output. each module runs in its own thread with its own intra-op pool 
+	# and reads from a bounded queue filled by the previous one, so module i trains on batch t while module i + 1 trains on batch t - 1
+	nstages, stop, errors, t0 = len(steps), threading.Event(), [], time.time()
+	queues = [queue.Queue(queuesize) for _ in range(nstages)]
+	busy, batches = [0.] * nstages, [0] * nstages
+	nthreads, nthreads0 = nthreads or max(1, available_cores() // nstages), torch.get_num_threads()
+	def put(q, item):
+		while not stop.is_set():
+			try:
+				return q.put(item, timeout = 0.1)
+			except queue.Full:
+				pass
+	def get(q):
+		while not stop.is_set():
+			try:
+				return q.get(timeout = 0.1)
+			except queue.Empty:
+				pass
+	def feed():
+		try:
+			for x, y in loader:
+				put(queues[0], (x.to(device), y.to(device)))
+		except BaseException as e:
+			errors.append(e)
+			stop.set()
+		put(queues[0], None)
+	def stage(i):
+		torch.set_num_threads(nthreads)
+		try:
+			while True:
+				item = get(queues[i])
+				if item is None:
+					break
+				t = time.time()
+				w = steps[i](*item)
+				busy[i] += time.time() - t
+				batches[i] += 1
+				if i + 1 < nstages:
+					put(queues[i + 1], (w, item[1]))
+		except BaseException as e:
+			errors.append(e)
+			stop.set()
+		if i + 1 < nstages:
+			put(queues[i + 1], None)
+	threads = [threading.Thread(target = feed, daemon = True)] + [threading.Thread(target = stage, args = (i, ), daemon = True) for i in range(nstages)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	torch.set_num_threads(nthreads0)
+	if errors:
+		raise errors[0]
+	wall = time.time() - t0
+	return [b / wall for b in busy], [wall - b for b in busy]
+
+class ReplayBuffer(object):
+	# bounded ring buffer of the detached outputs and labels of a module, read by the next module at its own rate. the producer never
+	# waits, the oldest entry is dropped when the buffer is full. the consumer takes the oldest unread entry, replays a random entry when
+	# it has read them all, and waits when there is none. an entry written maxstaleness or more producer steps ago is discarded
+	def __init__(self, size, maxstaleness):
+		self.size, self.maxstaleness, self.entries, self.version, self.closed = size, maxstaleness, [], 0, False
+		self.condition, self.rng = threading.Condition(), random.Random(0)
+		self.reads, self.replays, self.drops, self.occupancy, self.staleness = 0, 0, 0, 0, 0
+	def discard(self, keep):
+		# entries are [version, w, y, nreads]
+		self.drops += sum(1 for e in self.entries[: len(self.entries) - keep] if e[3] == 0)
+		self.entries = self.entries[len(self.entries) - keep :]
+	def put(self, w, y):
+		with self.condition:
+			self.version += 1
+			self.entries.append([self.version, w, y, 0])
+			self.discard(min(self.size, self.maxstaleness + 1))
+			self.condition.notify_all()
+	def close(self):
+		with self.condition:
+			self.closed = True
+			self.condition.notify_all()
+	def get(self, stop):
+		# returns None once the producer is done and every entry has been read
+		with self.condition:
+			while not stop.is_set():
+				self.discard(sum(1 for e in self.entries if self.version - e[0] <= self.maxstaleness))
+				unread = [e for e in self.entries if e[3] == 0]
+				if unread or (self.entries and not self.closed):
+					entry = unread[0] if unread else self.rng.choice(self.entries)
+					self.reads, self.replays = self.reads + 1, self.replays + (entry[3] > 0)
+					self.occupancy, self.staleness = self.occupancy + len(self.entries) / self.size, self.staleness + self.version - entry[0]
+					entry[3] += 1
+					return entry[1], entry[2]
+				if self.closed:
+					return None
+				self.condition.wait(0.1)
+	def stats(self):
+		n = max(self.reads, 1)
+		return {'occupancy': round(self.occupancy / n, 3), 'staleness': round(self.staleness / n, 3), 'replays': self.replays, 'drops': self.drops}
+
+def train_async(steps, loader, device, buffersize = 8, maxstaleness = 4, nthreads = None):
+	# steps[i](z, y) trains module i on one batch and returns its detached output. module 0 goes once through the loader, every other module
+	# reads the outputs of the previous one from a ReplayBuffer at its own rate until that module is done, so no module waits for a slower
+	# one. each module runs in its own thread with its own intra-op pool. returns the number of batches of each module and the stats of the buffers
+	if is_distributed():
+		raise ValueError('asynchronous training takes a different number of steps on each process and cannot be distributed')
+	nstages, stop, errors = len(steps), threading.Event(), []
+	buffers = [ReplayBuffer(buffersize, maxstaleness) for _ in range(nstages - 1)]
+	batches = [0] * nstages
+	nthreads, nthreads0 = nthreads or max(1, available_cores() // nstages), torch.get_num_threads()
+	def items(i):
+		if i == 0:
+			for x, y in loader:
+				if stop.is_set():
+					return
+				yield x.to(device), y.to(device)
+		else:
+			item = buffers[i - 1].get(stop)
+			while item is not None:
+				yield item
+				item = buffers[i - 1].get(stop)
+	def stage(i):
+		torch.set_num_threads(nthreads)
+		try:
+			for z, y in items(i):
+				w = steps[i](z, y)
+				batches[i] += 1
+				if i + 1 < nstages:
+					buffers[i].put(w, y)
+		except BaseException as e:
+			errors.append(e)
+			stop.set()
+		if i + 1 < nstages:
+			buffers[i].close()
+	threads = [threading.Thread(target = stage, args = (i, ), daemon = True) for i in range(nstages)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	torch.set_num_threads(nthreads0)
+	if errors:
+		raise errors[0]
+	return batches, [buffer.stats() for buffer in buffers]
+
+def unaugmented_loader(loader):
+	# the train loader over the same samples with the unaugmented transforms and collate set on it by the dataloaders functions. raises when 
+	# the loader does not give them, rather than caching augmented samples as unaugmented ones
+	if not hasattr(loader, 'unaugmented_transform'):
+		raise ValueError('the train loader does not give its unaugmented transforms, cache augmented views instead (actcacheviews > 0)')
+	dataset = loader.dataset
+	if isinstance(dataset, torchdata.Subset):
+		dataset = torchdata.Subset(copy.copy(dataset.dataset), dataset.indices)
+		dataset.dataset.transform = loader.unaugmented_transform
+	else:
+		dataset = copy.copy(dataset)
+		dataset.transform = loader.unaugmented_transform
+	collate_fn = loader.unaugmented_collate or torchdata.default_collate
+	return torchdata.DataLoader(dataset, batch_size = loader.batch_size, sampler = loader.sampler, num_workers = loader.num_workers, collate_fn = collate_fn)
+
+class ActivationCache(object):
+	# stores the output of the frozen prefix once so that later epochs stream it instead of recomputing the prefix. with nviews > 0, 
+	# that many augmented passes over the train loader are cached and cycled through, with nviews = 0 a single unaugmented pass is cached
+	def __init__(self, storage, nviews):
+		self.storage, self.nviews, self.folder = storage, nviews, None
+		self.views, self.epochs, self.buildtime, self.reused = [], 0, 0, 0
+	def batches(self, prefix, loader, device):
+		v = self.epochs % max(self.nviews, 1)
+		self.epochs += 1
+		if v < len(self.views):
+			self.reused += 1
+			return self.stream(self.views[v], loader.batch_size)
+		return self.build(prefix, loader if self.nviews > 0 else unaugmented_loader(loader), device)
+	def allocate(self, shape):
+		if self.storage == 'ram':
+			return torch.empty(shape)
+		if self.folder is None:
+			self.folder = tempfile.mkdtemp(prefix = 'actcache-', dir = os.getcwd())
+		path = os.path.join(self.folder, 'view{}.npy'.format(len(self.views)))
+		return torch.from_numpy(np.lib.format.open_memmap(path, mode = 'w+', dtype = np.float32, shape = tuple(shape)))
+	def build(self, prefix, loader, device):
+		zs, ys, n, t = None, [], 0, 0
+		for x, y in loader:
+			t1 = time.time()
+			with torch.no_grad():
+				z = x.to(device)
+				for module in prefix:
+					with autocast(module, device):
+						_, z, _ = module(z)
+			t += time.time() - t1
+			if zs is None:
+				zs = self.allocate([len(loader.sampler)] + list(z.shape[1:]))
+			zs[n: n + len(z)] = z.float().cpu()
+			ys.append(y)
+			n += len(z)
+			yield z, y
+		self.buildtime += t
+		self.views.append((zs[: n], torch.cat(ys)))
+	def stream(self, view, batchsize):
+		zs, ys = view
+		perm = torch.randperm(len(ys))
+		for k in range(0, len(ys), batchsize):
+			idx, _ = torch.sort(perm[k: k + batchsize])
+			yield zs[idx], ys[idx]
+	def report(self):
+		saved = self.reused * self.buildtime / max(len(self.views), 1)
+		print('Activation cache ({}, {} views): built in {:.1f} s, {} epochs streamed, ~{:.1f} s of prefix recompute saved'.format(self.storage, self.nviews, self.buildtime, self.reused, saved))
+	def close(self):
+		self.views = []
+		if self.folder is not None:
+			shutil.rmtree(self.folder, ignore_errors = True)
+			self.folder = None
+
+def evaluate(modules, criterion, loader, device):
+	# one chained no_grad pass of all modules over the loader. correct counts, loss sums, confusion matrices (true x predicted) and the histogram 
+	# of the first module that classifies each sample correctly (index nmodules = none) stay on the device and are read back with a single sync. 
+	# an empty loader gives zero accuracies and losses and empty confusion matrices
+	nmodules, n, correct = len(modules), 0, None
+	for module in modules:
+		module.eval()
+	with torch.no_grad():
+		for x, y in loader:
+			z, y = x.to(device), y.to(device)
+			first = torch.full_like(y, nmodules)
+			for i, module in enumerate(modules):
+				with autocast(module, device):
+					out, z, _ = module(z)
+				out = out.float()
+				if correct is None:
+					nclasses = out.shape[1]
+					correct, losses = torch.zeros(nmodules, dtype = torch.long, device = device), torch.zeros(nmodules, dtype = torch.double, device = device)
+					confusions = torch.zeros(nmodules, nclasses * nclasses, dtype = torch.long, device = device)
+					firstcorrect = torch.zeros(nmodules + 1, dtype = torch.long, device = device)
+				pred = out.argmax(1)
+				hit = pred == y
+				correct[i] += hit.sum()
+				losses[i] += criterion(out, y).double() * len(y)
+				confusions[i] += torch.bincount(y * nclasses + pred, minlength = nclasses * nclasses)
+				first = torch.where(hit & (first == nmodules), i, first)
+			firstcorrect += torch.bincount(first, minlength = nmodules + 1)
+			n += len(y)
+	if correct is None:
+		return np.zeros(nmodules), np.zeros(nmodules), np.zeros((nmodules, 0, 0), dtype = np.int64), np.zeros(nmodules + 1, dtype = np.int64)
+	flat = torch.cat([correct.double(), losses, confusions.flatten().double(), firstcorrect.double()]).cpu().numpy()
+	correct, losses, confusions, firstcorrect = np.split(flat, np.cumsum([nmodules, nmodules, nmodules * nclasses * nclasses]))
+	return correct / n, losses / n, confusions.reshape(nmodules, nclasses, nclasses).astype(np.int64), firstcorrect.astype(np.int64)
+
+def print_evaluation(confusions, firstcorrect):
+	# the confusion matrices (true x predicted) of the modules and the histogram of the first module that classifies each sample correctly, 
+	# as returned by evaluate
+	for i, confusion in enumerate(confusions):
+		print('Confusion matrix of module', i, '\n', confusion)
+	print('First correct module (last = none)', firstcorrect.tolist())
+
+def synchronize(device):
+	if torch.device(device).type == 'cuda':
+		torch.cuda.synchronize(device)
+
+def early_exit(modules, x, threshold, measure = 'confidence'):
+	# runs the modules in order on the batch x and lets each sample exit at the first classifier whose max softmax probability is >= threshold, 
+	# or whose entropy (normalized by log nclasses) is <= threshold. exited samples are dropped from the tensors fed to the next modules
+	nmodules, n = len(modules), x.shape[0]
+	preds, exits = torch.empty(n, dtype = torch.long, device = x.device), torch.empty(n, dtype = torch.long, device = x.device)
+	idx, z = torch.arange(n, device = x.device), x
+	for i, module in enumerate(modules):
+		with autocast(module, x.device):
+			out, z, _ = module(z)
+		p = torch.softmax(out.float(), 1)
+		if measure == 'confidence':
+			done = p.max(1)[0] >= threshold
+		else:
+			done = -(p * torch.log(p.clamp_min(1e-12))).sum(1) / math.log(out.shape[1]) <= threshold
+		if i == nmodules - 1:
+			done = torch.ones_like(done)
+		preds[idx[done]], exits[idx[done]] = out.argmax(1)[done], i
+		keep = ~done
+		if not keep.any():
+			break
+		idx, z = idx[keep], z[keep]
+	return preds, exits
+
+def early_exit_curve(modules, loader, device, measure = 'confidence', thresholds = None):
+	# accuracy / latency trade-off of early_exit over the thresholds. the last default threshold never exits early (full network)
+	if thresholds is None:
+		thresholds = [0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99, 2] if measure == 'confidence' else [0.5, 0.4, 0.3, 0.2, 0.1, 0.05, 0.01, -1]
+	nmodules, curve = len(modules), []
+	for module in modules:
+		module.eval()
+	with torch.no_grad():
+		for threshold in thresholds:
+			correct, exits, n, elapsed = 0, torch.zeros(nmodules, dtype = torch.long), 0, 0
+			for x, y in loader:
+				x, y = x.to(device), y.to(device)
+				synchronize(device)
+				t0 = time.time()
+				preds, exitindex = early_exit(modules, x, threshold, measure)
+				synchronize(device)
+				elapsed += time.time() - t0
+				correct += (preds == y).sum().item()
+				exits += torch.bincount(exitindex, minlength = nmodules).cpu()
+				n += len(y)
+			depth = (exits * torch.arange(1, nmodules + 1)).sum().item() / n
+			curve.append((threshold, correct / n, elapsed / n, depth, exits.tolist()))
+			print('Early exit', measure, threshold, 'accuracy', correct / n, 'ms/sample', 1000 * elapsed / n, 'modules/sample', depth, 'exits', exits.tolist())
+	return curve
+
+def fold_batchnorms(module):
+	# folds in place every batchnorm of the sequentials of an eval module into the conv or linear layer before it (blocks, 1C2F, 3LIN) or,
+	# when it follows a relu or a pooling, into the linear layer after it, flattened or not (1CNN). returns the number of folded batchnorms
+	nfolded = 0
+	for sequential in [m for m in module.modules() if isinstance(m, nn.Sequential)]:
+		layers = list(sequential)
+		for j, layer in enumerate(layers):
+			if not isinstance(layer, nn.modules.batchnorm._BatchNorm):
+				continue
+			after = [k for k in range(j + 1, len(layers)) if not isinstance(layers[k], (nn.Flatten, nn.Identity))]
+			if j > 0 and isinstance(layers[j - 1], (nn.Conv2d, nn.Linear)):
+				fuse = nn.utils.fusion.fuse_conv_bn_eval if isinstance(layers[j - 1], nn.Conv2d) else nn.utils.fusion.fuse_linear_bn_eval
+				sequential[j - 1] = fuse(layers[j - 1], layer)
+			elif after and isinstance(layers[after[0]], nn.Linear):
+				linear = layers[after[0]]
+				std = torch.sqrt(layer.running_var + layer.eps)
+				scale = layer.weight / std if layer.affine else 1 / std
+				shift = (layer.bias if layer.affine else 0) - layer.running_mean * scale
+				repeats = linear.in_features // len(scale)
+				folded = nn.Linear(linear.in_features, linear.out_features).to(linear.weight)
+				with torch.no_grad():
+					folded.weight.copy_(linear.weight * scale.repeat_interleave(repeats))
+					folded.bias.copy_(linear.weight @ shift.repeat_interleave(repeats) + (linear.bias if linear.bias is not None else 0))
+				sequential[after[0]] = folded
+			else:
+				continue
+			sequential[j] = nn.Identity()
+			nfolded += 1
+	return nfolded
+
+class ExportedStage(nn.Module):
+	# the blocks of one trained module, run without residues, and its classifier unless head is False
+	def __init__(self, module, head = True):
+		super(ExportedStage, self).__init__()
+		self.blocks, self.classifier = copy.deepcopy(module.blocks), copy.deepcopy(module.classifier) if head else nn.Identity()
+		self.classifier.__dict__.pop('forward', None)
+	def forward(self, x):
+		for block in self.blocks:
+			x, _ = block(x, False)
+		return x, self.classifier(x)
+
+class ExportedNetwork(nn.Module):
+	# the stages chained into one inference network returning the logits of the last classifier
+	def __init__(self, stages):
+		super(ExportedNetwork, self).__init__()
+		self.stages = nn.ModuleList(stages)
+	def forward(self, x):
+		out = x
+		for stage in self.stages:
+			x, out = stage(x)
+		return out
+
+class EarlyExitNetwork(ExportedNetwork):
+	# keeps the classifiers of all stages as early exits: stops at the first whose confidence (max softmax probability) is >= threshold, or
+	# whose normalized entropy is <= threshold, for every sample of the batch. returns its logits and its index
+	def __init__(self, stages, threshold, measure = 'confidence'):
+		super(EarlyExitNetwork, self).__init__(stages)
+		self.threshold, self.confidence = float(threshold), measure == 'confidence'
+	def forward(self, x):
+		out, index, done = x, 0, False
+		for i, stage in enumerate(self.stages):
+			if not done:
+				x, out = stage(x)
+				index = i
+				p = torch.softmax(out, 1)
+				if self.confidence:
+					done = bool((p.max(1)[0] >= self.threshold).all())
+				else:
+					done = bool((-(p * torch.log(p.clamp_min(1e-12))).sum(1) / math.log(float(out.shape[1])) <= self.threshold).all())
+		return out, index
+
+def export_network(modules, x, path, threshold = None, measure = 'confidence', nreps = 20):
+	# stitches the trained modules into one network on the cpu, with their batchnorms folded and the intermediate classifiers dropped, or kept 
+	# as early exits with a threshold. checks it against the modules on the batch x and saves it to path as a standalone TorchScript (.pt) 
+	# or ONNX (.onnx, without early exits) artifact that serving loads without these scripts. prints the latency per image before and after
+	if threshold is not None and path.endswith('.onnx'):
+		raise ValueError('early exits need data-dependent control flow, export them to TorchScript')
+	for module in modules:
+		module.eval()
+	nmodules = len(modules)
+	stages = [ExportedStage(module, threshold is not None or i == nmodules - 1).cpu().eval() for i, module in enumerate(modules)]
+	network = ExportedNetwork(stages) if threshold is None else EarlyExitNetwork(stages, float(threshold), measure)
+	x = x.float().cpu()
+	def latency(run):
+		times = []
+		with torch.no_grad():
+			for _ in range(nreps):
+				t = time.time()
+				run(x[: 1])
+				times.append(time.time() - t)
+		return 1000 * float(np.median(times))
+	# before and after run at the same threshold. with early exits, the folded network is also timed never exiting (and checked so), 
+	# which splits the speedup between folding and exiting
+	before = latency(network)
+	nfolded = sum(fold_batchnorms(stage) for stage in stages)
+	if threshold is not None:
+		network.threshold = 2. if measure == 'confidence' else -1.
+		noexit = latency(network)
+	with torch.no_grad():
+		z = x.to(next(modules[0].parameters()).device)
+		for module in modules:
+			out, z, _ = module(z, False)
+		folded = network(x)
+		error = ((folded if threshold is None else folded[0]) - out.float().cpu()).abs().max().item()
+		if path.endswith('.onnx'):
+			torch.onnx.export(network, (x, ), path, input_names = ['images'], output_names = ['logits'], dynamic_axes = {'images' : {0 : 'batch'}, 'logits' : {0 : 'batch'}})
+			exported = network
+		else:
+			if threshold is None:
+				exported = torch.jit.trace(network, x)
+			else:
+				z = x
+				for i, stage in enumerate(stages):
+					network.stages[i] = torch.jit.trace(stage, z)
+					z = stage(z)[0]
+				network.threshold = float(threshold)
+				exported = torch.jit.script(network)
+			torch.jit.save(exported, path)
+			exported = torch.jit.load(path)
+	after = latency(exported)
+	print('exported', nmodules, 'modules to', path, 'with', nfolded, 'batchnorms folded', 'and early exits at %s %s' % (measure, threshold) if threshold is not None else '', 
+		  '\nmax logit error on the batch', error, '\nlatency per image (cpu, ms)', round(before, 3), '->', round(after, 3), 
+		  '(folded without early exits %s)' % round(noexit, 3) if threshold is not None else '')
+	return exported, nfolded, error
+
 def update_meters(y, pred, loss, loss_meter, acc_meter, trs = None, trs_meter = None, t = None, time_meter = None):
 	num = len(y)
 	correct = (pred == y).sum().item()
@@ -533,7 +1592,26 @@ def neighboring_hit(points, labels):
 	return txs / len(points)
 
 
-
-
-
-
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-btr", "--benchtransport", default = None)
+	parser.add_argument("-bas", "--batchsize", type = int, default = 64)
+	parser.add_argument("-ims", "--imagesize", type = int, default = 96)
+	parser.add_argument("-nre", "--nreps", type = int, default = 10)
+	parser.add_argument("-bwp", "--benchwindowprocess", type = int, default = 0, choices = [0, 1])
+	parser.add_argument("-win", "--windowsize", type = int, default = 8)
+	parser.add_argument("-emb", "--embeddim", type = int, default = 96)
+	args = parser.parse_args()
+	device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+	if args.benchtransport is not None:
+		spec = importlib.util.spec_from_file_location('script', args.benchtransport)
+		script = importlib.util.module_from_spec(spec)
+		spec.loader.exec_module(script)
+		blocks = nn.ModuleList(script.backbone()).to(device)
+		benchmark_transport(blocks, torch.randn(args.batchsize, 3, args.imagesize, args.imagesize, device = device), args.nreps)
+	if args.benchwindowprocess:
+		# the shifted stages of a swin with patch size 4 on imagesize x imagesize images
+		resolution, dim = args.imagesize // 4, args.embeddim
+		while resolution > args.windowsize:
+			benchmark_window_process(args.batchsize, resolution, resolution, dim, args.windowsize, args.windowsize // 2, device, args.nreps)
+			resolution, dim = resolution // 2, 2 * dim